@@ -6,6 +6,7 @@
 # global project common utilities.
 
 import sys
+import io
 from os import sep, path, makedirs, walk, listdir, rmdir
 from os.path import dirname, basename, realpath, normpath, exists, isfile, getsize, splitext, join as path_join
 import socket
@@ -34,6 +35,7 @@ import logging
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
 from graphviz import Digraph
 from pandas.tseries.offsets import CustomBusinessDay, CustomBusinessHour
 from pandas.testing import assert_series_equal, assert_frame_equal
@@ -71,6 +73,9 @@ FMT_EXTS = {
 """Default Pandas DF IO format"""
 DF_DATA_FMT = 'arrow'
 
+"""Number of rows read at a time when filtering csv files by datetime range"""
+CSV_CHUNK_ROWS = 10**6
+
 """Dask Global Settings"""
 #dask.config.set(scheduler='threads')
 #dask.config.set(pool=ThreadPool(32))
@@ -1022,6 +1027,22 @@ def filter_null(arr):
 	"""
 	return arr[~pd.isnull(arr)]		# Filter None, NaN, and NaT values
 
+def np_merge_moments(count, mean, var, arr, axis=0):
+	"""
+	Merge the moments of arr (along axis) into a running count, mean, and (population) variance
+	with the parallel variance update of Chan et al, without revisiting the data already counted.
+
+	Returns:
+		Tuple of merged count, mean, and variance
+	"""
+	n_b = arr.shape[axis]
+	if (n_b == 0):
+		return count, mean, var
+	mean_b, var_b = np.mean(arr, axis=axis), np.var(arr, axis=axis)
+	n = count + n_b
+	delta = mean_b - mean
+	return n, mean + delta*n_b/n, (var*count + var_b*n_b + delta**2 * count*n_b/n) / n
+
 def np_inner(vals, nums, normalize=True):
 	"""
 	Return dot product of vals and nums, normalized by sum(nums) if desired.
@@ -1109,7 +1130,7 @@ def np_truncate_vstack_2d(arr, size):
 	If the size given doesn't allow the reshape, the array will be truncated at the last dimension.
 
 	Args:
-		arr (np.array): 2d numpy array
+		arr (np.array|list): 2d numpy array, or a list of 1d numpy arrays (the columns of the 2d array)
 		size (int): number of elements to stack in the last dimension
 
 	Returns:
@@ -1126,16 +1147,131 @@ def np_truncate_vstack_2d(arr, size):
 		                [ 2,  6, 10],
 		                [ 3,  7, 11]]])
 	"""
-	swap = arr.T
-	stack = np.hstack([np_truncate_split_1d(swap[i], size) for i in range(swap.shape[0])])
-	return np.reshape(stack, (stack.shape[0], swap.shape[0], size))
+	swap = arr.T if (is_type(arr, np.ndarray)) else arr
+	return np.stack([np_truncate_split_1d(col, size) for col in swap], axis=1)
+
+def np_ragged_vstack_2d(arr, idx, size, fill=np.nan):
+	"""
+	Reshape a 2d ndarray into a 3d ndarray of days, like np_truncate_vstack_2d but a day is
+	the run of rows sharing a date in idx rather than a fixed number of rows.
+	Days shorter than size (half days, missing bars) are padded at the end with fill,
+	the valid length of each day is given by np_day_lengths.
+	Rows past size in a day are dropped.
+	If every day has exactly size rows this is a plain reshape, otherwise only the valid rows are scattered.
+
+	Args:
+		arr (np.array|list): 2d numpy array, or a list of 1d numpy arrays (the columns of the 2d array)
+		idx (np.array): sorted datetime64 index of the rows
+		size (int): number of elements to stack in the last dimension (the longest day)
+		fill (scalar): value padded positions are filled with
+
+	Returns:
+		3d numpy array shaped (days, columns, size)
+	"""
+	swap = list(arr.T if (is_type(arr, np.ndarray)) else arr)
+	days = idx.astype('datetime64[D]')
+	new = np.empty(len(days), dtype=bool)
+	new[:1] = True
+	new[1:] = days[1:] != days[:-1]
+	starts = np.flatnonzero(new)
+	if (np.all(np.diff(np.append(starts, len(days))) == size)):
+		return np_truncate_vstack_2d(swap, size)
+
+	day = np.cumsum(new) - 1
+	pos = np.arange(len(days)) - starts[day]
+	keep = pos < size
+	day, pos = day[keep], pos[keep]
+	out = np.full((len(starts), len(swap), size), fill,
+		dtype=np.result_type(swap[0].dtype, np.min_scalar_type(fill)))
+	for h, col in enumerate(swap):
+		out[day, h, pos] = col[keep]
+	return out
+
+def np_day_lengths(idx, size):
+	"""
+	Number of rows of each day in idx (capped at size), the valid length of each day np_ragged_vstack_2d
+	stacks (positions from the length on are its padding).
+
+	Args:
+		idx (np.array): sorted datetime64 index of the rows
+		size (int): number of elements stacked in the last dimension (the longest day)
+
+	Returns:
+		1d int16 numpy array shaped (days,)
+	"""
+	days = idx.astype('datetime64[D]')
+	new = np.empty(len(days), dtype=bool)
+	new[:1] = True
+	new[1:] = days[1:] != days[:-1]
+	rows = np.diff(np.append(np.flatnonzero(new), len(days)))
+	return np.minimum(rows, size).astype(np.int16)
+
+
+""" ********** ARROW IO UTILS ********** """
+def get_dt_bounds(dt_range):
+	"""
+	Return the [start, end) bounds of a datetime range as numpy datetime64 objects,
+	a missing range or bound is returned as None.
+	"""
+	return tuple(None if (isnt(dt)) else np.datetime64(pd.Timestamp(dt))
+		for dt in (dt_range or (None, None)))
+
+def load_arrow_table(fpath, subset=None, dt_range=None, dt_col='datetime'):
+	"""
+	Memory map an Arrow IPC (feather v2) file and return it as a pyarrow Table.
+
+	Only the selected columns and the record batches that overlap dt_range are touched,
+	so the rest of the file is never read from disk. Batches are sliced to the range
+	without copying, which assumes the file is sorted by dt_col.
+
+	Args:
+		fpath (str): path to the arrow file
+		subset (list): names of columns to load, if None all columns are loaded
+		dt_range (tuple): [start, end) datetime range of rows to load,
+			either bound can be None, if None all rows are loaded
+		dt_col (str): name of the datetime column dt_range applies to
+
+	Returns:
+		pyarrow Table
+	"""
+	with pa.memory_map(fpath, 'r') as source:
+		reader = pa.ipc.open_file(source)
+		if (isnt(dt_range)):
+			table = reader.read_all()
+		else:
+			start, end = get_dt_bounds(dt_range)
+			batches = []
+			for i in range(reader.num_record_batches):
+				batch = reader.get_batch(i)
+				dts = batch.column(dt_col).to_numpy(zero_copy_only=False)
+				lo = 0 if (isnt(start)) else np.searchsorted(dts, start, side='left')
+				hi = len(dts) if (isnt(end)) else np.searchsorted(dts, end, side='left')
+				if (hi > lo):
+					batches.append(batch.slice(lo, hi-lo))
+			table = pa.Table.from_batches(batches, schema=reader.schema)
+	return table if (isnt(subset)) else table.select(subset)
 
 
 """ ********** PANDAS IO UTILS ********** """
-def load_df(fname, dir_path=None, data_format=DF_DATA_FMT, subset=None, dti_freq=None):
+def load_df(fname, dir_path=None, data_format=DF_DATA_FMT, subset=None, dti_freq=None,
+	dt_range=None, dt_col='datetime'):
 	"""
 	Read and return the df file in the given directory and
 	assume that the file has an index as the first column
+
+	Args:
+		fname (str): file name
+		dir_path (str): directory of the file
+		data_format (str): file format, see FMT_EXTS
+		subset (list): names of columns to load, if None all columns are loaded
+		dti_freq (str): frequency to set on the loaded datetime index
+		dt_range (tuple): [start, end) datetime range of rows to load,
+			either bound can be None, if None all rows are loaded
+		dt_col (str): name of the datetime column (or index) dt_range applies to
+
+	The column subset and datetime range are pushed down into the read for arrow, feather,
+	and parquet files, and csv files are filtered chunk by chunk while reading.
+	Other formats are filtered after loading.
 	"""
 	ext_tuple = FMT_EXTS[data_format]
 	fpath = str(add_sep_if_none(dir_path) + fname) if dir_path else fname
@@ -1144,15 +1280,27 @@ def load_df(fname, dir_path=None, data_format=DF_DATA_FMT, subset=None, dti_freq
 
 	if (isfile(fpath)):
 		try:
-			df = {
-				'csv': partial(pd.read_csv, index_col=0, usecols=subset),
-				'arrow': partial(pd.read_feather),
-				'feather': partial(pd.read_feather),
-				'hdf_fixed': partial(pd.read_hdf, key=None, mode='r', columns=subset, format='fixed'),
-				'hdf_table': partial(pd.read_hdf, key=None, mode='r', columns=subset, format='table'),
-				'parquet': partial(pd.read_parquet, columns=subset),
-				'pickle': pd.read_pickle
-			}.get(data_format)(fpath)
+			if (data_format in ('arrow', 'feather')):
+				cols = subset
+				if (data_format == 'feather' and is_valid(subset) and 'id' not in subset):
+					cols = ['id', *subset]
+				df = load_arrow_table(fpath, subset=cols, dt_range=dt_range, dt_col=dt_col).to_pandas()
+			elif (data_format == 'csv' and is_valid(dt_range)):
+				chunks = pd.read_csv(fpath, index_col=0, usecols=subset, chunksize=CSV_CHUNK_ROWS)
+				df = pd.concat([df_dt_range(chunk, dt_range, dt_col) for chunk in chunks])
+			else:
+				df = {
+					'csv': partial(pd.read_csv, index_col=0, usecols=subset),
+					'hdf_fixed': partial(pd.read_hdf, key=None, mode='r', columns=subset, format='fixed'),
+					'hdf_table': partial(pd.read_hdf, key=None, mode='r', columns=subset, format='table'),
+					'parquet': partial(pd.read_parquet, columns=subset, filters=get_dt_filters(dt_range, dt_col)),
+					'pickle': pd.read_pickle
+				}.get(data_format)(fpath)
+
+				if (data_format == 'pickle' and is_valid(subset)):
+					df = df.loc[:, [col for col in subset if (col in df.columns)]]
+				if (is_valid(dt_range)):
+					df = df_dt_range(df, dt_range, dt_col)
 
 			if (data_format == 'feather'):
 				df = df.set_index('id')
@@ -1173,6 +1321,28 @@ def load_df(fname, dir_path=None, data_format=DF_DATA_FMT, subset=None, dti_freq
 	else:
 		raise FileNotFoundError('{} must be in: {}'.format(basename(fpath), dirname(fpath)))
 
+def get_dt_filters(dt_range, dt_col='datetime'):
+	"""
+	Return a [start, end) datetime range as parquet row filters (None if there is no range).
+	"""
+	start, end = get_dt_bounds(dt_range)
+	filters = [(dt_col, op, pd.Timestamp(dt)) for op, dt in (('>=', start), ('<', end)) if (is_valid(dt))]
+	return filters or None
+
+def df_dt_range(df, dt_range, dt_col='datetime'):
+	"""
+	Return the rows of df in the [start, end) datetime range,
+	dt_col can be a column or the index of df.
+	"""
+	start, end = get_dt_bounds(dt_range)
+	dts = pd.to_datetime(df[dt_col] if (dt_col in df.columns) else df.index).to_numpy()
+	mask = np.ones(len(df), dtype=bool)
+	if (is_valid(start)):
+		mask &= dts >= start
+	if (is_valid(end)):
+		mask &= dts < end
+	return df.loc[mask]
+
 def dump_df(df, fname, dir_path=None, data_format=DF_DATA_FMT):
 	ext_tuple = FMT_EXTS[data_format]
 	fpath = str(add_sep_if_none(dir_path) + fname) if dir_path else fname
@@ -1196,6 +1366,155 @@ def dump_df(df, fname, dir_path=None, data_format=DF_DATA_FMT):
 		raise e
 
 
+""" ********** NUMPY IO UTILS ********** """
+NPY_EXT = '.npy'
+
+def load_npy(fname, dir_path=None, mmap_mode='r'):
+	"""
+	Read and return the numpy array file in the given directory.
+	By default the array is memory mapped read-only, so nothing is read from disk
+	until the array is accessed and the pages can be shared between processes.
+	"""
+	fpath = str(add_sep_if_none(dir_path) + fname) if dir_path else fname
+	if (not fname.endswith(NPY_EXT)):
+		fpath += NPY_EXT
+
+	if (isfile(fpath)):
+		return np.load(fpath, mmap_mode=mmap_mode, allow_pickle=False)
+	else:
+		raise FileNotFoundError('{} must be in: {}'.format(basename(fpath), dirname(fpath)))
+
+def load_arrow_np(fname, dir_path=None, subset=None, dt_range=None, dt_col='datetime'):
+	"""
+	Memory map an Arrow IPC (feather v2) file and return its columns as numpy arrays,
+	without building a pandas DataFrame.
+
+	Columns of an uncompressed file that are a single record batch without nulls
+	are returned as zero copy read only views into the memory map
+	(the arrow files dumped by the julia preprocessing are like this),
+	other columns are copied.
+
+	Args:
+		fname (str): file name
+		dir_path (str): directory of the file
+		subset (list): names of columns to load, if None all columns are loaded
+		dt_range (tuple): [start, end) datetime range of rows to load, see load_arrow_table
+		dt_col (str): name of the datetime column dt_range applies to
+
+	Returns:
+		dict of column name to numpy array, in file column order
+	"""
+	ext_tuple = FMT_EXTS['arrow']
+	fpath = str(add_sep_if_none(dir_path) + fname) if dir_path else fname
+	if (not fname.endswith(ext_tuple)):
+		fpath += ext_tuple[0]
+
+	if (isfile(fpath)):
+		table = load_arrow_table(fpath, subset=subset, dt_range=dt_range, dt_col=dt_col)
+		return {
+			name: col.chunk(0).to_numpy(zero_copy_only=False) if (col.num_chunks == 1) \
+				else col.to_numpy()
+			for name, col in zip(table.column_names, table.columns)
+		}
+	else:
+		raise FileNotFoundError('{} must be in: {}'.format(basename(fpath), dirname(fpath)))
+
+def append_npy(arr, fname, dir_path=None):
+	"""
+	Append rows (along the first axis) to the numpy array file in the given directory.
+	Only the new rows and the header are written, unless the grown shape no longer fits
+	in the existing header, then the file is rewritten.
+	The rows are written before the header, so readers never see a shape past the written data.
+	"""
+	fpath = str(add_sep_if_none(dir_path) + fname) if dir_path else fname
+	if (not fname.endswith(NPY_EXT)):
+		fpath += NPY_EXT
+
+	with open(fpath, 'r+b') as f:
+		version = np.lib.format.read_magic(f)
+		read_header, write_header = (np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0) \
+			if (version == (1, 0)) else (np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0)
+		shape, fortran_order, dtype = read_header(f)
+		offset = f.tell()
+		arr = np.ascontiguousarray(arr, dtype=dtype)
+		assert not fortran_order and arr.shape[1:] == shape[1:]
+
+		header = io.BytesIO()
+		write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+			'shape': (shape[0]+arr.shape[0], *shape[1:])})
+		if (header.tell() == offset):
+			f.seek(offset + int(np.prod(shape))*dtype.itemsize)
+			f.write(arr.tobytes())
+			f.flush()
+			f.seek(0)
+			f.write(header.getvalue())
+			return
+
+	dump_npy(np.concatenate([load_npy(fpath, mmap_mode=None), arr]), fpath)
+
+def load_arrow_schema(fname, dir_path=None):
+	"""
+	Read the schema of an Arrow IPC (feather v2) file without reading any of its record batches.
+	"""
+	ext_tuple = FMT_EXTS['arrow']
+	fpath = str(add_sep_if_none(dir_path) + fname) if dir_path else fname
+	if (not fname.endswith(ext_tuple)):
+		fpath += ext_tuple[0]
+
+	if (isfile(fpath)):
+		with pa.memory_map(fpath, 'r') as source:
+			return pa.ipc.open_file(source).schema
+	else:
+		raise FileNotFoundError('{} must be in: {}'.format(basename(fpath), dirname(fpath)))
+
+def iter_arrow_np(fname, dir_path=None, subset=None, dt_range=None, dt_col='datetime'):
+	"""
+	Memory map an Arrow IPC (feather v2) file and yield its record batches one at a time,
+	each as a dict of column name to numpy array (zero copy where possible, see load_arrow_np).
+	Only one record batch is touched at a time, so files larger than memory can be streamed.
+
+	Args:
+		fname (str): file name
+		dir_path (str): directory of the file
+		subset (list): names of columns to load, if None all columns are loaded
+		dt_range (tuple): [start, end) datetime range of rows to load, see load_arrow_table
+		dt_col (str): name of the datetime column dt_range applies to
+	"""
+	ext_tuple = FMT_EXTS['arrow']
+	fpath = str(add_sep_if_none(dir_path) + fname) if dir_path else fname
+	if (not fname.endswith(ext_tuple)):
+		fpath += ext_tuple[0]
+	if (not isfile(fpath)):
+		raise FileNotFoundError('{} must be in: {}'.format(basename(fpath), dirname(fpath)))
+
+	start, end = get_dt_bounds(dt_range)
+	with pa.memory_map(fpath, 'r') as source:
+		reader = pa.ipc.open_file(source)
+		for i in range(reader.num_record_batches):
+			batch = reader.get_batch(i)
+			if (is_valid(dt_range)):
+				dts = batch.column(dt_col).to_numpy(zero_copy_only=False)
+				lo = 0 if (isnt(start)) else np.searchsorted(dts, start, side='left')
+				hi = len(dts) if (isnt(end)) else np.searchsorted(dts, end, side='left')
+				batch = batch.slice(lo, max(hi-lo, 0))
+			if (batch.num_rows > 0):
+				yield {name: batch.column(name).to_numpy(zero_copy_only=False)
+					for name in (subset or batch.schema.names)}
+
+def dump_npy(arr, fname, dir_path=None):
+	fpath = str(add_sep_if_none(dir_path) + fname) if dir_path else fname
+	if (not fname.endswith(NPY_EXT)):
+		fpath += NPY_EXT
+
+	try:
+		np.save(fpath, np.ascontiguousarray(arr), allow_pickle=False)
+		return getsize(fpath) // BYTES_PER_MEGABYTE
+
+	except Exception as e:
+		logging.error('error during dump:', e)
+		raise e
+
+
 """ ********** PANDAS GENERAL UTILS ********** """
 DEFAULT_IDX_NAME = 'id'
 ALL_COLS = ':'
@@ -0,0 +1,240 @@
+import sys
+import os
+from os.path import sep, exists, getmtime
+import shutil
+import tempfile
+import fcntl
+import hashlib
+import json
+import logging
+from contextlib import contextmanager
+
+from common_util import load_json, dump_json, load_npy, dump_npy, append_npy, makedir_if_not_exists, isnt
+from data.common import CACHE_VERSION, CACHE_BUDGET
+
+
+def file_fingerprint(fpath, content=False, block_size=1<<24):
+	"""
+	Fingerprint of an input file.
+	By default this is its path, size, and modification time, with content=True it is its size and
+	the sha256 of its bytes instead (slower, but survives copies and touches of unchanged files).
+	"""
+	st = os.stat(fpath)
+	if (not content):
+		return [os.path.realpath(fpath), st.st_size, st.st_mtime_ns]
+	digest = hashlib.sha256()
+	with open(fpath, "rb") as f:
+		for block in iter(lambda: f.read(block_size), b""):
+			digest.update(block)
+	return [st.st_size, digest.hexdigest()]
+
+class ArtifactCache:
+	"""
+	Content addressed cache of preprocessing artifacts.
+
+	An artifact is a dict of named numpy arrays output by a preprocessing stage, it is stored under
+	a key hashed from the stage, its params, and the fingerprints of its input files (see file_fingerprint).
+	So any process asking for the same stage over the same inputs and params gets the stored artifact,
+	and a changed input file or param simply addresses a different entry.
+
+	Entries are laid out as root/<key>/{<name>.npy, meta.json}, are written to a temporary directory
+	and moved into place (readers never see a partial entry), and are memory mapped when read.
+	The least recently used entries are evicted once the stored artifacts exceed budget bytes,
+	entries being built or appended to are never evicted and processes that mapped an evicted
+	entry keep their mappings.
+
+	Args:
+		root (str): cache directory, shared by every data module using it
+		budget (int): bytes of artifacts kept before the least recently used are evicted
+		hash_content (bool): fingerprint input files by content hash instead of size/mtime
+		mmap_mode (str): mode artifacts are memory mapped with, 'r' maps them read-only
+	"""
+	def __init__(self, root, budget=CACHE_BUDGET, hash_content=False, mmap_mode='r'):
+		self.root = root.rstrip(sep) +sep
+		self.budget = budget
+		self.hash_content = hash_content
+		self.mmap_mode = mmap_mode
+		self.hashes = {} # content hashes by (path, size, mtime)
+
+	def fingerprint(self, fpath):
+		if (not self.hash_content):
+			return file_fingerprint(fpath)
+		st = os.stat(fpath)
+		stamp = (os.path.realpath(fpath), st.st_size, st.st_mtime_ns)
+		if (stamp not in self.hashes):
+			self.hashes[stamp] = file_fingerprint(fpath, content=True)
+		return self.hashes[stamp]
+
+	def get_key(self, stage, params, paths=()):
+		"""
+		Key of the artifact of stage with params (a json serializable dict) over the input files at paths.
+		"""
+		blob = json.dumps({"version": CACHE_VERSION, "stage": stage, "params": params,
+			"inputs": [self.fingerprint(fpath) for fpath in paths]}, sort_keys=True, default=str)
+		return f"{stage}-{hashlib.sha256(blob.encode()).hexdigest()[:32]}"
+
+	def get_path(self, key):
+		return f"{self.root}{key}{sep}"
+
+	@contextmanager
+	def lock(self, key, blocking=True):
+		"""
+		Exclusive lock on an entry, yields whether it was acquired (always if blocking).
+		"""
+		lock_dir = f"{self.root}.lock{sep}"
+		makedir_if_not_exists(lock_dir)
+		with open(f"{lock_dir}{key}", "w") as lock:
+			try:
+				fcntl.flock(lock, fcntl.LOCK_EX if (blocking) else fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				yield False
+				return
+			yield True
+
+	def get(self, key):
+		"""
+		Memory map the arrays of an entry, returns None if there is no entry for key.
+		Reading an entry marks it as used.
+		"""
+		path = self.get_path(key)
+		if (not exists(path)):
+			return None
+		try:
+			meta = load_json("meta.json", path)
+			arrays = {name: load_npy(name, path, mmap_mode=self.mmap_mode) for name in meta["names"]}
+			os.utime(f"{path}meta.json")
+		except FileNotFoundError:
+			return None # evicted while being read
+		return arrays
+
+	def put(self, key, arrays, stage=None):
+		"""
+		Store arrays under key, then evict the least recently used entries over budget.
+		"""
+		makedir_if_not_exists(self.root)
+		tmp_dir = tempfile.mkdtemp(prefix=".tmp", dir=self.root) +sep
+		for name, arr in arrays.items():
+			dump_npy(arr, name, tmp_dir)
+		dump_json({"stage": stage, "names": list(arrays), "size": self.get_size(tmp_dir)}, "meta.json", tmp_dir)
+
+		path = self.get_path(key)
+		if (exists(path)):
+			shutil.rmtree(path, ignore_errors=True)
+		try:
+			os.rename(tmp_dir, path)
+		except OSError:
+			shutil.rmtree(tmp_dir, ignore_errors=True)
+		logging.debug(f"stored artifact {key} in {self.root}")
+		self.evict(keep=(key,))
+
+	def get_or_build(self, stage, params, build_fn, paths=()):
+		"""
+		Return the key and arrays of the artifact of stage, calling build_fn to build and store it if missing.
+		One process builds a missing artifact, concurrent ones block until it is stored then map it.
+		The builder maps the stored artifact too (and drops what it built), so every process gets
+		the same memory mapped arrays and holds no private copy of them.
+
+		Returns:
+			(key, dict of memory mapped arrays)
+		"""
+		key = self.get_key(stage, params, paths)
+		with self.lock(key):
+			arrays = self.get(key)
+			if (arrays is not None):
+				logging.debug(f"artifact cache hit: {key}")
+				return key, arrays
+			logging.debug(f"artifact cache miss: {key}")
+			built = build_fn()
+			self.put(key, built, stage=stage)
+			arrays = self.get(key)
+		if (arrays is None):
+			logging.warning(f"artifact {key} was evicted as it was stored, using the built arrays")
+			return key, built
+		return key, arrays
+
+	def append(self, key, new_key, arrays):
+		"""
+		Append rows to the arrays of an entry in place and move it to new_key, so an artifact
+		whose inputs only grew is brought up to date without rewriting it.
+		Returns whether the entry was there to append to.
+		"""
+		with self.lock(key):
+			path = self.get_path(key)
+			if (not exists(path)):
+				return False
+			for name, arr in arrays.items():
+				append_npy(arr, name, path)
+			meta = load_json("meta.json", path)
+			meta["size"] = self.get_size(path)
+			dump_json(meta, "meta.json", path)
+			if (new_key != key):
+				try:
+					os.rename(path, self.get_path(new_key))
+				except OSError:
+					# another process already stored the up to date artifact
+					shutil.rmtree(path, ignore_errors=True)
+		self.evict(keep=(new_key,))
+		return True
+
+	def remove(self, key):
+		with self.lock(key):
+			shutil.rmtree(self.get_path(key), ignore_errors=True)
+
+	def get_users_path(self, key):
+		lock_dir = f"{self.root}.lock{sep}"
+		makedir_if_not_exists(lock_dir)
+		return f"{lock_dir}{key}.users"
+
+	def attach(self, key):
+		"""
+		Register this process as a user of an entry, returns the handle to pass to remove_unused.
+		The process holds a shared lock on the entry's users file until the handle is closed (or it exits).
+		"""
+		users = open(self.get_users_path(key), "w")
+		fcntl.flock(users, fcntl.LOCK_SH)
+		return users
+
+	def remove_unused(self, key, users=None):
+		"""
+		Close the users handle of this process and remove the entry if no other process is attached to it.
+		Returns whether the entry was removed.
+		"""
+		if (users is not None):
+			users.close()
+		with open(self.get_users_path(key), "w") as lock:
+			try:
+				fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				return False
+			self.remove(key)
+		return True
+
+	def evict(self, keep=()):
+		"""
+		Remove the least recently used entries (by the last time they were read or stored)
+		until the stored artifacts fit in the budget.
+		"""
+		entries = []
+		for key in os.listdir(self.root):
+			meta_path = f"{self.get_path(key)}meta.json"
+			if (key.startswith(".") or not exists(meta_path)):
+				continue
+			try:
+				entries.append((getmtime(meta_path), load_json(meta_path)["size"], key))
+			except (FileNotFoundError, ValueError):
+				continue
+		total = sum(size for _, size, _ in entries)
+		for _, size, key in sorted(entries):
+			if (total <= self.budget):
+				break
+			if (key in keep):
+				continue
+			with self.lock(key, blocking=False) as acquired:
+				if (acquired):
+					shutil.rmtree(self.get_path(key), ignore_errors=True)
+					total -= size
+					logging.info(f"evicted artifact {key} from {self.root}")
+
+	@staticmethod
+	def get_size(path):
+		return sum(os.path.getsize(f"{path}{name}") for name in os.listdir(path))
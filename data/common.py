@@ -17,6 +17,13 @@ from os import sep
 from common_util import DATA_DIR
 
 # PACKAGE CONSTANTS
+CACHE_NAME = "cache"
+CACHE_VERSION = "003" # bump when the layout of cached arrays changes
+CACHE_DIR = DATA_DIR +CACHE_NAME +sep # artifact cache shared by every data module
+CACHE_BUDGET = 64 * 2**30 # bytes of artifacts kept before the least recently used are evicted
+SHM_DIR = "/dev/shm/" # tmpfs the shared data modules are published to
+SHM_NAME = "thesis-xgdm"
+SHM_BUDGET = 8 * 2**30
 
 # PACKAGE DEFAULTS
 PROC_NAME = "002"
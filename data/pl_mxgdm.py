@@ -0,0 +1,153 @@
+import sys
+import os
+from os.path import sep
+from functools import partial, reduce
+import logging
+
+import numpy as np
+
+from common_util import NestedDefaultDict, isnt, is_valid
+from data.pl_xgdm import XGDataModule
+from data.window_util import overlap_win_preproc_3d, WindowedDataset, PooledEpisodeDataset
+
+
+class MultiXGDataModule(XGDataModule):
+	"""
+	Multi Asset Experiment Group Data Module
+	Loads several assets into one set of arrays with an explicit asset axis,
+	aligned on the trading days common to all assets:
+		* index: (n,)
+		* feature: (n, A, C, H, W)
+		* length, return, target: (n, A)
+
+	Every asset is loaded by its own XGDataModule (so the on disk and shared memory caches are reused),
+	windowing, episodes and loaders are then built once for all assets.
+	The target of each asset is standardized by its own statistics.
+	Each observation has the same shape as in the single asset module, the asset is picked
+	by the loader: get_dataloader(split) pools the episodes of all assets (a batch mixes assets),
+	get_dataloader(split, asset_name) only draws the episodes of that asset.
+
+	Args:
+		params_d (dict): data params, as in XGDataModule
+		asset_names (list): names of the assets to load, in asset axis order
+		**kwargs: passed on to each asset's XGDataModule
+	"""
+	def __init__(self, params_d, asset_names=("SPX", "RUT", "NDX", "DJI"), **kwargs):
+		self.asset_names = list(asset_names)
+		super().__init__(params_d, asset_name=",".join(self.asset_names), **kwargs)
+		self.assets = [XGDataModule(params_d, asset_name=asset_name, **kwargs)
+			for asset_name in self.asset_names]
+		self.use_cache = False # the stacked arrays are not cached, only the arrays of each asset
+
+	def prepare_data(self):
+		"""
+		Prepare each asset and stack them on the asset axis over their common trading days.
+		"""
+		self.data = NestedDefaultDict()
+		self.memo = {}
+		self.buffers = {}
+		for dm in self.assets:
+			dm.prepare_data()
+
+		for split in self.SPLITS:
+			aligned = self.align(split, [{kind: dm.data[[split, kind]] for kind in self.KINDS} for dm in self.assets])
+			for kind in self.KINDS:
+				self.data[[split, kind]] = aligned[kind]
+
+		for dm in self.assets:
+			dm.data = NestedDefaultDict() # the stacked arrays are copies
+
+	def align(self, split, rows):
+		"""
+		Stack the prepared arrays of each asset on the asset axis over their common trading days.
+
+		Args:
+			split (str): split the arrays are from
+			rows (list): dict of kind to array of each asset
+
+		Returns:
+			dict of kind to stacked array
+		"""
+		idxs = [row["index"] for row in rows]
+		common = reduce(np.intersect1d, idxs)
+		for asset_name, idx in zip(self.asset_names, idxs):
+			if (len(idx) != len(common)):
+				logging.debug(f"{split} {asset_name}: dropped {len(idx)-len(common)} days not common to all assets")
+		pos = [np.searchsorted(idx, common) for idx in idxs]
+		aligned = {"index": common}
+		for kind in ("feature", "length", "return", "target"):
+			aligned[kind] = np.stack([row[kind][p] for row, p in zip(rows, pos)], axis=1)
+		return aligned
+
+	def read_rows(self, split, dt_range=None):
+		return self.align(split, [dm.read_rows(split, dt_range) for dm in self.assets])
+
+	def build_windowed(self, split, window_size):
+		index, = overlap_win_preproc_3d((self.data[[split, "index"]],), window_size)
+		target = self.data[[split, "target"]][window_size-1:]
+		ret = self.data[[split, "return"]][window_size-1:]
+		length, = overlap_win_preproc_3d((self.data[[split, "length"]],), window_size, same_dims=False) # (n, A, window_size)
+		feature = self.memoized("feature", split, partial(self.get_feature_tensor, split))
+		return index, [WindowedDataset(feature[:, a], window_size) for a in range(len(self.assets))], target, ret, length
+
+	def build_episodes(self, split):
+		"""
+		Episodic dataset of each asset pooled into one, the episodes of an asset
+		are gathered straight from its slice of the stacked tensors.
+		"""
+		index, features, target, ret, length = self.get_windowed(split)
+		datasets = [self.get_meta_dataset((index, feature, target[:, a], ret[:, a], length[:, a]), split)
+			for a, feature in enumerate(features)]
+		dataset = PooledEpisodeDataset(datasets)
+		if (self.params_d["standardize"]):
+			self.apply_stats(dataset, self.standardize("target"))
+		return index, dataset
+
+	@staticmethod
+	def apply_stats(dataset, stats):
+		loc, scale = stats
+		for a, asset_dataset in enumerate(dataset.datasets):
+			asset_dataset.target_stats = (float(loc[a]), float(scale[a]))
+
+	def extend_episodes(self, key, dataset):
+		split, params = key[0], dict(zip(self.EPISODE_PARAMS, key[1:]))
+		index, features, target, ret, length = self.memoized("window", (split, params["window_size"]),
+			partial(self.build_windowed, split, params["window_size"]))
+		for a, asset_dataset in enumerate(dataset.datasets):
+			base = self.get_tensors((index, features[a], target[:, a], ret[:, a], length[:, a]), delta=params["forecast_delta"])
+			asset_dataset.extend(base, *self.get_episode_index(base[0], split, params, start_step=len(asset_dataset)))
+		return index, dataset
+
+	def standardize(self, subset="target", sample_split="train"):
+		"""
+		Standardization statistics of each asset, the mean and std are shaped (A,).
+		"""
+		return self.memoized("stats", (subset, sample_split), lambda: (
+			np.mean(self.data[[sample_split, subset]], axis=0),
+			np.std(self.data[[sample_split, subset]], axis=0)))
+
+	def get_fshape(self):
+		"""
+		Shape of each (single asset) feature observation, (C, H, W).
+		"""
+		if (isnt(self.fshape)):
+			_fshape = list(self.data[["train", "feature"]][0, 0].shape)
+			_fshape[-1] *= self.params_d["window_size"]
+			self.fshape = tuple(_fshape)
+		return self.fshape
+
+	def get_dataloader(self, split, asset_name=None, fields=None):
+		"""
+		Pooled DataLoader over the episodes of all assets,
+		or the DataLoader of one asset if asset_name is set.
+		"""
+		dataset = self.dataset[split]
+		if (is_valid(asset_name)):
+			dataset = dataset.datasets[self.asset_names.index(asset_name)]
+		return self.get_fields_dataloader(split, dataset, fields or self.fields)
+
+	def get_source_paths(self):
+		return [path for dm in self.assets for path in dm.get_source_paths()]
+
+	def get_target_names(self, split="train"):
+		return self.assets[0].get_target_names(split)
@@ -1,17 +1,22 @@
 import sys
 import os
 from os.path import sep
+from functools import partial
+from multiprocessing.pool import ThreadPool
 import logging
+import warnings
 
 import numpy as np
 import pandas as pd
 import torch
-from torch.utils.data import TensorDataset, DataLoader
+from torch.utils.data import TensorDataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
 import pytorch_lightning as pl
 
-from common_util import DATA_DIR, NestedDefaultDict, load_df, isnt, is_valid, np_truncate_vstack_2d
-from data.common import PROC_NAME, VENDOR_NAME
-from data.window_util import overlap_win_preproc_3d, windowed_ctx_tgt
+from common_util import DATA_DIR, NestedDefaultDict, load_df, load_arrow_np, load_arrow_schema, np_merge_moments, benchmark, is_type, isnt, is_valid, np_ragged_vstack_2d, np_day_lengths
+from data.common import PROC_NAME, VENDOR_NAME, CACHE_DIR, SHM_DIR, SHM_NAME, SHM_BUDGET
+from data.cache_util import ArtifactCache
+from data.window_util import overlap_win_preproc_3d, windowed_ctx_tgt, WindowedDataset, EpisodeDataset, BatchLoader, EPISODE_FIELDS
+from data.stream_util import StreamEpisodeDataset
 
 
 class XGDataModule(pl.LightningDataModule):
@@ -27,10 +32,51 @@ class XGDataModule(pl.LightningDataModule):
 
 	Note: "target" here refers to the regression target, it is not used in the sense
 		of neural process context/target observation sets.
+
+	The preprocessing artifacts are cached in the content addressed ArtifactCache at CACHE_DIR,
+	keyed by the fingerprints of the arrow files they are built from and the params they depend on:
+		* feature: each feature file read and cut into days, in the storage dtype
+		* target: the index, return, and target columns of each target file
+		* data: the prepared arrays of all splits, only stored by shared data modules (in shared memory)
+	so later runs (and the other trials of a sweep) memory map them instead of rereading the arrow files,
+	and the artifacts of one file are reused by every feature set it is part of.
+	Set use_cache=False to always rebuild from the arrow files.
+	When the data is (re)built all arrow files are read concurrently on a pool of io_workers threads.
+	The later stages (standardization statistics, windows, episodes) are cheap next to these,
+	they are memoized in memory (see setup()).
+
+	The features are stored (in memory and in the cache) as params_d["feature_dtype"] (see FEATURE_DTYPES,
+	float32 by default), a 16 bit dtype halves the feature memory. Batches are upcast to float32 as they
+	are gathered, so models always see float32. The storage dtype is fixed when the data module is created
+	(update() rejects a change to it).
+
+	Trading days are cut from the minutely rows by date, not by a fixed row count, so the source files
+	can hold irregular days: days shorter than day_size (half days, missing bars) are NaN padded at the end,
+	the valid length of each day is kept in the "length" arrays and shipped with the episodes (lc, lt),
+	models built on padded data mask their input by it (see is_padded), a NaN in the data itself is never masked.
+
+	With shared=True the cache is published to shared memory (SHM_DIR) instead. Every process using the same asset/feature/target attaches to the same pages read-only,
+	so the base arrays are held in memory once no matter how many studies run side by side
+	(an in-place write to them fails instead of silently making a private copy).
+	Only one process builds and publishes the arrays, the others wait for it and attach.
+
+	With stream=True the features are never loaded, each split is a StreamEpisodeDataset
+	that streams the feature days from the memory mapped arrow files as batches are drawn,
+	for histories (or feature sets) larger than memory. Only the per day index, target and
+	return arrays are prepared, and the shuffle is local to chunks of STREAM_SHUFFLE_BATCHES batches.
 """
+	SPLITS = ("train", "val", "test")
+	KINDS = ("index", "feature", "length", "return", "target")
+	EPISODE_PARAMS = ("window_size", "forecast_delta", "context_size", "target_size",
+		"step_size", "overlap_size", "resample_context", "standardize")
+	LOADER_PARAMS = ("batch_size", "shuffle", "num_workers", "pin_memory")
+	STREAM_SHUFFLE_BATCHES = 16
+	MEMO_SIZES = {"window": 6, "episode": 6, "loader": 12} # entries kept per setup stage, a few param sets per split
+	FEATURE_DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
 
 	def __init__(self, params_d, proc_name=PROC_NAME, vendor_name=VENDOR_NAME, asset_name="SPX",
-		feature_name="price,ivol", target_name="rvol_1day_r_1min_std", return_name="R_1day"):
+		feature_name="price,ivol", target_name="rvol_1day_r_1min_std", return_name="R_1day",
+		use_cache=True, io_workers=None, shared=False, stream=False):
 		super().__init__()
 		self.params_d = params_d
 		self.proc_name = proc_name
@@ -41,34 +87,174 @@ class XGDataModule(pl.LightningDataModule):
 		self.return_name = return_name
 		self.name = f"{asset_name}{sep}{target_name}{sep}{feature_name}"
 		self.ddir = f"{DATA_DIR}{self.proc_name}{sep}{self.vendor_name}{sep}{self.asset_name}"
+		self.shared = shared
+		self.feature_dtype = self.params_d.get("feature_dtype", "float32")
+		assert self.feature_dtype in self.FEATURE_DTYPES, f"feature_dtype must be one of {list(self.FEATURE_DTYPES)}"
+		self.stream = stream
+		self.use_cache = (use_cache or shared) and not stream
+		self.cache = ArtifactCache(CACHE_DIR)
+		self.data_cache = ArtifactCache(SHM_DIR +SHM_NAME, budget=SHM_BUDGET, mmap_mode='r') \
+			if (self.shared) else self.cache
+		self.data_key = None
+		self.artifact_keys = {}
+		self.users = None # handle attaching this process to the shared data artifact
+		self.io_workers = io_workers
+		self.read_times = {}
+		self.memo = {}
+		self.buffers = {}
+		self.fields = None
 		self.target_names = None
 		self.fshape = None
 		if (self.vendor_name == "frd"):
-			self.day_size = 391 # number of data points per trading day
+			self.day_size = 391 # number of data points per (full) trading day
 		if (self.params_d["forecast_delta"]==0):
 			logging.warning("Forecast delta is '0', labels will not be shifted forward in time.")
 
-	def prepare_feature(self, split="train"):
+	def read_feature(self, split, name, dt_range=None):
+		"""
+		Read a feature file and reshape it to (n, H, W), also returns the minutely datetime index.
+
+		The rows are cut into days by their date, W is day_size (the longest day)
+		and days with fewer bars (half days) are NaN padded at the end, see np_ragged_vstack_2d.
+		The arrow file is memory mapped and reshaped straight from its
+		columns, the only copy made is the reshaped output.
+		Only the rows in dt_range are read if it is set.
+		"""
+		col = load_arrow_np(name, f"{self.ddir}/{split}/feature", dt_range=dt_range)
+		idx = col.pop("datetime")
+		return idx, np_ragged_vstack_2d(list(col.values()), idx, self.day_size)
+
+	def read_target(self, split, dt_range=None):
+		"""
+		Read the datetime, return, and target columns of the target file.
+		Only the rows in dt_range are read if it is set.
+		"""
+		return load_df("price", f"{self.ddir}/{split}/target",
+			subset=["datetime", self.return_name, self.target_name], dt_range=dt_range).set_index("datetime")
+
+	def read_rows(self, split, dt_range=None):
+		"""
+		Read and prepare the rows of a split in dt_range.
+
+		Returns:
+			dict of kind to prepared array, and the minutely datetime index of the features at "minutes"
+		"""
+		reads = [self.read_feature(split, name, dt_range) for name in self.feature_name.split(',')]
+		np_feature = self.prepare_feature(split, reads)
+		np_index, np_return, np_target = self.prepare_target(split, self.read_target(split, dt_range))
+		days = np.unique(reads[0][0].astype("datetime64[D]"))
+		assert np.array_equal(days, np_index.astype("datetime64[D]")), \
+			f"{self.name} {split}: the feature days don't match the target index"
+		assert np_feature.shape[0] == np_index.shape[0]
+		return {"index": np_index, "feature": np_feature, "length": np_day_lengths(reads[0][0], self.day_size),
+			"return": np_return, "target": np_target, "minutes": reads[0][0]}
+
+	def load_feature(self, split, name):
+		"""
+		read_feature output of a feature file with the feature in the storage dtype,
+		through the artifact cache if use_cache is set.
+		"""
+		if (not self.use_cache):
+			idx, arr = self.read_feature(split, name)
+			return idx, self.to_storage(arr)
+
+		def build():
+			idx, arr = self.read_feature(split, name)
+			return {"index": idx, "feature": self.to_storage(arr)}
+		arrays = self.load_artifact(split, "feature", name, build)
+		return arrays["index"], arrays["feature"]
+
+	def load_target(self, split):
+		"""
+		prepare_target output of a split, through the artifact cache if use_cache is set.
+		"""
+		if (not self.use_cache):
+			return self.prepare_target(split, self.read_target(split))
+
+		def build():
+			return dict(zip(("index", "return", "target"), self.prepare_target(split, self.read_target(split))))
+		arrays = self.load_artifact(split, "target", "price", build)
+		return arrays["index"], arrays["return"], arrays["target"]
+
+	def get_artifact_params(self, kind):
+		"""
+		Params the artifact of a feature or target file depends on.
+		"""
+		return {"day_size": self.day_size, "feature_dtype": self.feature_dtype} if (kind == "feature") \
+			else {"return_name": self.return_name, "target_name": self.target_name}
+
+	def get_artifact_key(self, split, kind, name):
+		"""
+		Artifact cache key of the feature or target file of a split.
+		"""
+		return self.cache.get_key(kind, self.get_artifact_params(kind), [self.get_source_path(split, kind, name)])
+
+	def load_artifact(self, split, kind, name, build_fn):
+		"""
+		Artifact of the feature or target file of a split, built by build_fn if missing.
+		Its key is kept in self.artifact_keys so ingest() can append to it.
+		"""
+		key, arrays = self.cache.get_or_build(kind, self.get_artifact_params(kind), build_fn,
+			paths=[self.get_source_path(split, kind, name)])
+		self.artifact_keys[(split, kind, name)] = key
+		return arrays
+
+	def read_all(self):
+		"""
+		Run every feature and target load of every split concurrently on a thread pool
+		(pyarrow and numpy release the GIL while reading and copying).
+		The wall time of each load is logged and stored in self.read_times.
+
+		Returns:
+			NestedDefaultDict with load_feature outputs at [split, "feature", name]
+			and load_target outputs at [split, "target"]
+		"""
+		jobs = [([split, "feature", name], partial(self.load_feature, split, name))
+			for split in self.SPLITS for name in self.feature_name.split(',')]
+		jobs.extend([([split, "target"], partial(self.load_target, split)) for split in self.SPLITS])
+
+		def timed_read(job):
+			key, read_fn = job
+			with benchmark('/'.join(key), suppress=True) as b:
+				out = read_fn()
+			return key, out, b.delta.total_seconds()
+
+		reads = NestedDefaultDict()
+		with ThreadPool(self.io_workers or len(jobs)) as pool:
+			for key, out, sec in pool.imap_unordered(timed_read, jobs):
+				reads[key] = out
+				self.read_times['/'.join(key)] = sec
+				logging.info(f"read {self.asset_name}/{'/'.join(key)}: {sec:.3f}s")
+		return reads
+
+	def prepare_feature(self, split="train", reads=None):
 		"""
 		outputs data shaped like (n, C, H, W).
 			n - index
 			C - channels (financial instrument/ticker)
 			H - columns (open, high, low, close, etc)
 			W - window (time sequence in index aggregation period)
+
+		Args:
+			split (str): split to prepare
+			reads (list): read_feature outputs of each feature, if None the files are read here
 		"""
-		dfs = [load_df(name, f"{self.ddir}/{split}/feature").set_index("datetime")
-			for name in self.feature_name.split(',')]
-		assert all((df.index == dfs[0].index).all() for df in dfs)
-		arrs = [np_truncate_vstack_2d(df.to_numpy(), self.day_size) for df in dfs]
+		reads = reads or [self.read_feature(split, name) for name in self.feature_name.split(',')]
+		idxs, arrs = zip(*reads)
+		assert all(np.array_equal(idx, idxs[0]) for idx in idxs)
 		assert all(arr.shape == arrs[0].shape for arr in arrs)
 		return np.stack(arrs, axis=1)
 
-	def prepare_target(self, split="train"):
+	def prepare_target(self, split="train", price=None):
 		"""
 		outputs data shaped like (n,).
 			n - index
+
+		Args:
+			split (str): split to prepare
+			price (pd.DataFrame): read_target output, if None the file is read here
 		"""
-		price = load_df("price", f"{self.ddir}/{split}/target").set_index("datetime")
+		price = self.read_target(split) if (isnt(price)) else price
 		np_index = price.index.to_numpy()
 		np_return = price.loc[:, self.return_name].to_numpy()
 		np_target = price.loc[:, self.target_name].to_numpy()
@@ -82,39 +268,333 @@ class XGDataModule(pl.LightningDataModule):
 		Operations here should not depend on params_d,
 		so that params_d can be modified without this method
 		needing to be caled again.
+
+		If use_cache is set, the arrays are built from the feature and target artifacts of the artifact cache.
+		Shared data modules also store the prepared arrays as the "data" artifact in shared memory,
+		mapped read-only, so it backs tensors without a copy while the pages stay shared
+		with every other attached process (the publishing process maps it too). Other modules don't, it would only duplicate the
+		feature artifacts (their stacked features are copied into memory either way).
 		"""
 		self.data = NestedDefaultDict()
-		for split in ["train", "val", "test"]:
-			np_feature = self.prepare_feature(split)
-			np_index, np_return, np_target = self.prepare_target(split)
-			assert np_feature.shape[0] == np_index.shape[0]
-			self.data[[split, "index"]] = np_index
-			self.data[[split, "feature"]] = np_feature
-			self.data[[split, "return"]] = np_return
-			self.data[[split, "target"]] = np_target
+		self.memo = {}
+		self.buffers = {}
+		if (self.use_cache and self.shared):
+			self.attach(self.data_cache.get_key("data", self.get_data_params(), self.get_source_paths()))
+			self.data_key, arrays = self.data_cache.get_or_build("data", self.get_data_params(),
+				self.build_data, paths=self.get_source_paths())
+		else:
+			arrays = self.build_data()
+		for name, arr in arrays.items():
+			self.data[name.split("_")] = arr
+
+	def build_data(self):
+		"""
+		Load the feature and target artifacts and build the prepared arrays.
+		Streaming data modules only prepare the (per day) index, return, and target.
+
+		Returns:
+			dict of "{split}_{kind}" to prepared array
+		"""
+		arrays = {}
+		if (self.stream):
+			for split in self.SPLITS:
+				np_index, np_return, np_target = self.prepare_target(split)
+				arrays.update({f"{split}_index": np_index, f"{split}_return": np_return, f"{split}_target": np_target})
+			return arrays
+
+		reads = self.read_all()
+		for split in self.SPLITS:
+			np_feature = self.prepare_feature(split,
+				[reads[[split, "feature", name]] for name in self.feature_name.split(',')])
+			np_length = np_day_lengths(reads[[split, "feature", self.feature_name.split(',')[0]]][0], self.day_size)
+			np_index, np_return, np_target = reads[[split, "target"]]
+			assert np_feature.shape[0] == np_length.shape[0] == np_index.shape[0]
+			arrays.update({f"{split}_index": np_index, f"{split}_feature": np_feature, f"{split}_length": np_length,
+				f"{split}_return": np_return, f"{split}_target": np_target})
+		return arrays
+
+	def get_data_params(self):
+		return {"day_size": self.day_size, "feature_dtype": self.feature_dtype, "feature_name": self.feature_name,
+			"target_name": self.target_name, "return_name": self.return_name, "kinds": list(self.KINDS)}
+
+	def get_source_path(self, split, kind, name):
+		return f"{self.ddir}/{split}/{kind}/{name}.arrow"
+
+	def get_source_paths(self):
+		"""
+		Paths of all arrow files read by prepare_data.
+		"""
+		return [self.get_source_path(split, kind, name)
+			for split in self.SPLITS
+			for kind, names in (("feature", self.feature_name.split(',')), ("target", ["price"]))
+			for name in names]
 
 	def setup(self, stage=None):
 		"""
 		Apply moving window to the features,
-		make the TensorDatasets and samplers used to later create DataLoaders.
+		make the episodic datasets used to later create DataLoaders.
 		Depends on params_d.
+
+		The windowed features are never materialized, they are a WindowedDataset
+		over the (n, C, H, W) feature tensor that gathers windows when indexed.
+
+		Setup is staged and every stage is memoized on the params it depends on:
+			* window: windowed arrays, keyed by window_size
+			* episode: episodic datasets, keyed by EPISODE_PARAMS
+				(and LOADER_PARAMS when streaming, the batches are built by the dataset)
+			* loader: dataloaders, keyed by LOADER_PARAMS
+		so after an update() only the invalidated stages are recomputed.
+		These stages only keep their most recently used entries (see MEMO_SIZES), so sweeping
+		over many params doesn't hold every windowed array, dataset, and loader built along the way.
 		"""
 		self.index, self.dataset, self.sampler = {}, {}, {}
-		if (self.params_d["standardize"]):
-			self.standardize("target")
-
-		for split in ["train", "val", "test"]:
-			windowed = overlap_win_preproc_3d((
-					self.data[[split, "index"]],
-					self.data[[split, "feature"]],
-					self.data[[split, "target"]],
-					self.data[[split, "return"]]
-				),
-				self.params_d["window_size"],
-				same_dims=True
-			)
-			self.index[split] = windowed[0]
-			self.dataset[split] = self.get_meta_dataset(windowed, split)
+		for split in self.SPLITS:
+			self.index[split], self.dataset[split] = self.memoized("episode",
+				self.get_episode_key(split), partial(self.build_episodes, split))
+
+	def get_episode_key(self, split):
+		key = (split, *self.get_params_key(self.EPISODE_PARAMS))
+		return key + self.get_params_key(self.LOADER_PARAMS) if (self.stream) else key
+
+	def memoized(self, stage, key, build_fn):
+		"""
+		Return the memoized output of a setup stage for key, calling build_fn to build it if missing.
+		The least recently used entry of a stage in MEMO_SIZES is evicted once it holds more entries than that.
+		"""
+		cache = self.memo.setdefault(stage, {})
+		if (key in cache):
+			cache[key] = cache.pop(key) # most recently used last
+		else:
+			cache[key] = build_fn()
+			if (len(cache) > self.MEMO_SIZES.get(stage, len(cache))):
+				del cache[next(iter(cache))]
+		return cache[key]
+
+	def get_params_key(self, names):
+		return tuple(self.params_d[name] for name in names)
+
+	def get_windowed(self, split):
+		"""
+		Windowed (index, feature, target, return, length) of a split, memoized on window_size.
+		The feature tensor is built once per split and shared by every window size.
+		"""
+		window_size = self.params_d["window_size"]
+		return self.memoized("window", (split, window_size),
+			partial(self.build_windowed, split, window_size))
+
+	def build_windowed(self, split, window_size):
+		index, target, ret, length = overlap_win_preproc_3d((
+				self.data[[split, "index"]],
+				self.data[[split, "target"]],
+				self.data[[split, "return"]],
+				self.data[[split, "length"]][:, None]
+			),
+			window_size
+		)
+		feature = self.memoized("feature", split, partial(self.get_feature_tensor, split))
+		return index, WindowedDataset(feature, window_size), target, ret, length
+
+	def to_storage(self, feature):
+		"""
+		Convert a feature array to the storage dtype, numpy has no bfloat16 so it is stored as its uint16 bits.
+		"""
+		if (self.feature_dtype == "bfloat16"):
+			bf16 = torch.from_numpy(np.ascontiguousarray(feature, dtype=np.float32)).to(torch.bfloat16)
+			return bf16.view(torch.int16).numpy().view(np.uint16)
+		return feature.astype(self.feature_dtype, copy=False)
+
+	def get_feature_tensor(self, split):
+		"""
+		Feature tensor of a split in the storage dtype. The read-only shared memory mapping of a shared
+		data module and writable arrays (like the buffers ingest() appends to) are wrapped without a copy,
+		the tensor over the shared mapping must not be written to (the pages are mapped read-only).
+		"""
+		feature = self.data[[split, "feature"]]
+		bits = feature.dtype == np.uint16 # bfloat16 bits
+		if (bits):
+			feature = feature.view(np.int16)
+		if (feature.flags.writeable):
+			tensor = torch.from_numpy(feature)
+		elif (self.shared):
+			with warnings.catch_warnings():
+				warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+				tensor = torch.from_numpy(feature)
+		else:
+			tensor = torch.tensor(feature, requires_grad=False)
+		return tensor.view(torch.bfloat16) if (bits) else tensor
+
+	def is_padded(self):
+		"""
+		Whether any feature day is shorter than day_size (so it is padded, see np_ragged_vstack_2d),
+		ie whether a model has to mask its input (see AttentiveNP). Each split is checked once,
+		streaming data modules can't check ahead of time and are always taken to be padded.
+		"""
+		if (self.stream):
+			return True
+		return any(self.memoized("padded", split, partial(self.has_padding, self.data[[split, "length"]]))
+			for split in self.SPLITS)
+
+	def has_padding(self, length):
+		return bool(np.any(length < self.day_size))
+
+	def unpublish(self):
+		"""
+		Detach from the shared memory artifact of this data module and remove it if no other process
+		is attached to it, so the last process using it frees the memory. Call it when done with the module.
+		The arrays already mapped by this process stay valid.
+
+		Returns:
+			whether the artifact was removed
+		"""
+		if (not self.shared or isnt(self.data_key)):
+			return False
+		removed = self.data_cache.remove_unused(self.data_key, self.users)
+		self.users = None
+		return removed
+
+	def attach(self, key):
+		"""
+		Attach this process to the shared data artifact at key (detaching from the previous one),
+		it is not removed by the unpublish() of another process until this one detaches.
+		"""
+		if (is_valid(self.users)):
+			self.users.close()
+		self.users = self.data_cache.attach(key)
+
+	def build_episodes(self, split):
+		if (self.stream):
+			return self.build_stream_episodes(split)
+		windowed = self.get_windowed(split)
+		return windowed[0], self.get_meta_dataset(windowed, split)
+
+	def ingest(self, split="test"):
+		"""
+		Append the trading days added to the source files of a split since it was prepared.
+
+		Only the new rows are read (the datetime range is pushed down to the arrow reader) and
+		appended to buffers backing self.data whose capacity grows geometrically. The memoized windows
+		and episodes of the split are extended in place with the episodes over the new rows,
+		the standardization statistics are updated by merging in the moments of the new rows,
+		and the new rows are appended to the cached artifacts if use_cache is set.
+		So the cost of a refresh is proportional to the new data, not to the whole history
+		(except for copying the per day index/target/return tensors).
+
+		Returns:
+			number of days appended
+		"""
+		# the day after the last one, the time of day of the index is not assumed to be fixed
+		last = self.data[[split, "index"]][-1].astype("datetime64[D]")
+		rows = self.read_rows(split, dt_range=(last + np.timedelta64(1, "D"), None))
+		rows["feature"] = self.to_storage(rows["feature"])
+		if (len(rows["index"]) == 0):
+			return 0
+
+		self.update_stats(split, rows)
+		for kind in self.KINDS:
+			self.data[[split, kind]] = self.append_rows(split, kind, rows[kind])
+		if (self.use_cache):
+			self.append_cache(split, rows)
+
+		if (split in self.memo.get("feature", {})):
+			self.memo["feature"][split] = self.get_feature_tensor(split)
+		if (split in self.memo.get("padded", {})):
+			self.memo["padded"][split] |= self.has_padding(rows["length"])
+		for key in self.memo.get("window", {}):
+			if (key[0] == split):
+				self.memo["window"][key] = self.build_windowed(*key)
+		for key, (index, dataset) in self.memo.get("episode", {}).items():
+			if (key[0] == split):
+				self.memo["episode"][key] = self.extend_episodes(key, dataset)
+		if (split in getattr(self, "dataset", {})):
+			self.index[split], self.dataset[split] = self.memoized("episode",
+				self.get_episode_key(split), partial(self.build_episodes, split))
+		self.memo.pop("loader", None) # field views of the datasets don't see the appended episodes
+		logging.info(f"{self.name} {split}: ingested {len(rows['index'])} days")
+		return len(rows["index"])
+
+	def append_rows(self, split, kind, rows):
+		"""
+		Append rows to the split/kind array, which becomes a view of a buffer with spare capacity
+		(doubled whenever it runs out), so repeated appends cost O(len(rows)) amortized.
+		"""
+		arr = self.data[[split, kind]]
+		n, m = len(arr), len(arr)+len(rows)
+		buf = self.buffers.get((split, kind))
+		if (isnt(buf) or len(buf) < m):
+			buf = np.empty((max(2*n, m), *arr.shape[1:]), dtype=arr.dtype)
+			buf[:n] = arr
+			self.buffers[(split, kind)] = buf
+		buf[n:m] = rows
+		return buf[:m]
+
+	def append_cache(self, split, rows):
+		"""
+		Append new rows of a split to its cached artifacts (the artifacts of its feature and target files,
+		and the shared data artifact), which move to the keys of the grown source files.
+		"""
+		appends = [((split, "feature", name), {"index": rows["minutes"], "feature": rows["feature"][:, c]})
+			for c, name in enumerate(self.feature_name.split(','))]
+		appends.append(((split, "target", "price"), {kind: rows[kind] for kind in ("index", "return", "target")}))
+		for file_key, arrays in appends:
+			key = self.get_artifact_key(*file_key)
+			if (file_key not in self.artifact_keys or not self.cache.append(self.artifact_keys[file_key], key, arrays)):
+				logging.debug(f"{'/'.join(file_key)} artifact is not cached, not appending to it")
+				continue
+			self.artifact_keys[file_key] = key
+
+		if (self.shared):
+			key = self.data_cache.get_key("data", self.get_data_params(), self.get_source_paths())
+			self.attach(key)
+			if (not self.data_cache.append(self.data_key, key, {f"{split}_{kind}": rows[kind] for kind in self.KINDS})):
+				logging.debug(f"data artifact {self.data_key} was evicted, not appending to it")
+			self.data_key = key
+
+	def update_stats(self, split, rows):
+		"""
+		Merge the new rows of a split into the memoized standardization statistics sampled from it
+		(streaming mean/variance update) and apply them to the memoized episodic datasets.
+		"""
+		for (subset, sample_split), (mean, std) in self.memo.get("stats", {}).items():
+			if (sample_split != split):
+				continue
+			count = len(self.data[[split, subset]])
+			count, mean, var = np_merge_moments(count, mean, std**2, rows[subset])
+			self.memo["stats"][(subset, sample_split)] = stats = (mean, np.sqrt(var))
+			if (subset == "target"):
+				for key, (index, dataset) in self.memo.get("episode", {}).items():
+					if (dict(zip(self.EPISODE_PARAMS, key[1:]))["standardize"]):
+						self.apply_stats(dataset, stats)
+
+	@staticmethod
+	def apply_stats(dataset, stats):
+		dataset.target_stats = tuple(map(float, stats))
+
+	def extend_episodes(self, key, dataset):
+		"""
+		Extend a memoized episodic dataset over the appended rows of its split.
+		"""
+		split, params = key[0], dict(zip(self.EPISODE_PARAMS, key[1:]))
+		windowed = self.memoized("window", (split, params["window_size"]),
+			partial(self.build_windowed, split, params["window_size"]))
+		base = self.get_tensors(windowed, delta=params["forecast_delta"])
+		dataset.extend(base, *self.get_episode_index(base[0], split, params, start_step=len(dataset)))
+		return windowed[0], dataset
+
+	def build_stream_episodes(self, split):
+		train_mode = split=='train'
+		index, = overlap_win_preproc_3d((self.data[[split, "index"]],), self.params_d["window_size"])
+		shuffle = self.params_d['shuffle'] and train_mode
+		return index, StreamEpisodeDataset(f"{self.ddir}/{split}/feature", self.feature_name.split(','),
+			self.day_size, self.data[[split, "index"]], self.data[[split, "target"]], self.data[[split, "return"]],
+			self.params_d["window_size"], self.params_d["forecast_delta"],
+			self.params_d['context_size'], self.params_d['target_size'],
+			(self.params_d['step_size'] if (train_mode) else self.params_d['context_size']) \
+				or self.params_d['context_size'],
+			self.params_d['overlap_size'], self.params_d['batch_size'],
+			resample_context=self.params_d['resample_context'] and train_mode,
+			target_stats=self.standardize("target") if (self.params_d["standardize"]) else None,
+			shuffle=shuffle, chunk_batches=self.STREAM_SHUFFLE_BATCHES if (shuffle) else 1,
+			feature_dtype=self.FEATURE_DTYPES[self.feature_dtype])
 
 	def get_fshape(self):
 		"""
@@ -127,26 +607,85 @@ class XGDataModule(pl.LightningDataModule):
 			* W: data row (lookback window)
 		"""
 		if (isnt(self.fshape)):
-			_fshape = list(self.data[["train", "feature"]][0].shape)
+			if (self.stream):
+				names = self.feature_name.split(',')
+				schema = load_arrow_schema(names[0], f"{self.ddir}/train/feature")
+				_fshape = [len(names), len(schema.names)-1, self.day_size]
+			else:
+				_fshape = list(self.data[["train", "feature"]][0].shape)
 			_fshape[-1] *= self.params_d["window_size"]
 			self.fshape = tuple(_fshape)
 		return self.fshape
 
 	def update(self, new):
+		"""
+		Set new params_d, only the setup stages whose params changed are recomputed.
+		The feature storage dtype is fixed when the data module is created, changing it raises a ValueError.
+		"""
+		if (new.get("feature_dtype", "float32") != self.feature_dtype):
+			raise ValueError(f"feature_dtype can't be changed by update() ({self.feature_dtype} to "
+				f"{new.get('feature_dtype', 'float32')}), create a new data module instead")
 		if (self.params_d != new):
+			if (self.params_d["window_size"] != new["window_size"]):
+				self.fshape = None
 			self.params_d = new
-			self.fshape = None
 			self.setup()
 
-	def get_dataloader(self, split):
-		return DataLoader(self.dataset[split],
-			batch_size=self.params_d['batch_size'],
-			shuffle=self.params_d['shuffle'] and split=='train',
-			drop_last=True, # TODO
+	def set_fields(self, fields):
+		"""
+		Declare the episode fields (see EPISODE_FIELDS) the consumer of the loaders reads,
+		the rest are not gathered and are None in each batch. If None all fields are shipped.
+		"""
+		assert isnt(fields) or set(fields) <= set(EPISODE_FIELDS)
+		self.fields = fields
+
+	def get_dataloader(self, split, fields=None):
+		"""
+		The loader draws batches of episode indices and the episodic dataset
+		gathers each whole batch at once (no per episode fetch and collate), see build_dataloader.
+		Only fields (or the fields set by set_fields if None) are gathered.
+		Memoized on the split dataset, fields, LOADER_PARAMS, and the world size of the trainer.
+		"""
+		return self.get_fields_dataloader(split, self.dataset[split], fields or self.fields)
+
+	def get_fields_dataloader(self, split, dataset, fields):
+		return self.memoized("loader",
+			(split, id(dataset), fields and tuple(sorted(fields)), *self.get_params_key(self.LOADER_PARAMS),
+				self.get_world_size()),
+			partial(self.build_dataloader, split, dataset if (isnt(fields)) else dataset.with_fields(fields)))
+
+	def build_dataloader(self, split, dataset):
+		"""
+		In process (num_workers=0) loading uses a BatchLoader, each batch is one vectorized gather
+		built ahead on a background thread. Otherwise a DataLoader with worker processes is used,
+		and always when training is distributed: the trainer shards a DataLoader's sampler across
+		its processes, a BatchLoader would give every process all of the batches.
+		"""
+		shuffle = self.params_d['shuffle'] and split=='train'
+		if (self.params_d['num_workers'] == 0 and self.get_world_size() == 1
+			and not is_type(dataset, StreamEpisodeDataset)):
+			return BatchLoader(dataset, self.params_d['batch_size'], shuffle=shuffle,
+				drop_last=True, pin_memory=self.params_d['pin_memory'])
+		if (is_type(dataset, StreamEpisodeDataset)):
+			return DataLoader(dataset, batch_size=None,
+				num_workers=self.params_d['num_workers'],
+				pin_memory=self.params_d['pin_memory'])
+		sampler = RandomSampler(dataset) if (shuffle) else SequentialSampler(dataset)
+		return DataLoader(dataset,
+			sampler=BatchSampler(sampler, batch_size=self.params_d['batch_size'],
+				drop_last=True), # TODO
+			batch_size=None,
 			num_workers=self.params_d['num_workers'],
 			pin_memory=self.params_d['pin_memory']
 		)
 
+	def get_world_size(self):
+		"""
+		Number of processes the attached trainer runs, 1 if there is none.
+		"""
+		trainer = getattr(self, "trainer", None)
+		return getattr(trainer, "world_size", 1) if (is_valid(trainer)) else 1
+
 	train_dataloader = lambda self: self.get_dataloader('train')
 	val_dataloader = lambda self: self.get_dataloader('val')
 	test_dataloader = lambda self: self.get_dataloader('test')
@@ -159,13 +698,13 @@ class XGDataModule(pl.LightningDataModule):
 
 	def standardize(self, subset="target", sample_split="train"):
 		"""
-		Standardize by sample mean, std statistics.
+		Standardization (sample mean, std) statistics of a subset, computed once from sample_split.
+		The data is left as is, the episodic datasets standardize the target as batches are fetched,
+		so setup() can be called any number of times.
 		"""
-		sample_mean = np.mean(self.data[[sample_split, subset]])
-		sample_std = np.std(self.data[[sample_split, subset]])
-
-		for split in ["train", "val", "test"]:
-			self.data[[split, subset]] = (self.data[[split, subset]] - sample_mean) / sample_std
+		return self.memoized("stats", (subset, sample_split), lambda: (
+			float(np.mean(self.data[[sample_split, subset]])),
+			float(np.std(self.data[[sample_split, subset]]))))
 
 	@staticmethod
 	def rename_ohlc(df, pfx):
@@ -180,7 +719,7 @@ class XGDataModule(pl.LightningDataModule):
 	@staticmethod
 	def get_tensors(data, delta=1):
 		"""
-		Return tuple of index, features, targets, returns tensor.
+		Return tuple of index, features, targets, returns (and day lengths) tensor.
 		Shift index, feature, target, etc appropriately by delta.
 
 		Note that the index of t+delta is stored (ie the index of the label),
@@ -191,17 +730,24 @@ class XGDataModule(pl.LightningDataModule):
 		the stacked model label.
 
 		Args:
-			data (tuple): tuple of numpy arrays, features are the first element
+			data (tuple): tuple of numpy arrays, features are the second element
+				and can also be a (lazy) WindowedDataset, the windowed day lengths are the optional fifth element
 
 		Returns:
-			tuple of tensors
+			tuple of tensors (features are returned as a WindowedDataset if they were passed as one)
 		"""
 		i = torch.arange(len(data[0][delta:]), requires_grad=False) # int index to avoid storing datetime in tensor
-		f = torch.tensor(data[1][:data[1].shape[0]-delta], dtype=torch.float32, requires_grad=False)
+		f = data[1][:data[1].shape[0]-delta]
+		if (not is_type(f, WindowedDataset)):
+			f = torch.tensor(f, dtype=torch.float32, requires_grad=False)
 		t = torch.tensor(data[2][delta:], dtype=torch.float32, requires_grad=False)
 		r = torch.tensor(data[3][delta:], dtype=torch.float32, requires_grad=False)
 		assert all(d.shape[0]==i.shape[0] for d in [f, t, r])
-		return i, f, t, r
+		if (len(data) < 5):
+			return i, f, t, r
+		l = torch.tensor(data[4][:data[4].shape[0]-delta], dtype=torch.int16, requires_grad=False)
+		assert l.shape[0]==i.shape[0]
+		return i, f, t, r, l
 
 	def get_dataset(self, data):
 		"""
@@ -209,7 +755,7 @@ class XGDataModule(pl.LightningDataModule):
 			* n: dataset size (number of observations)
 			* *: observation dimensions
 		"""
-		return TensorDataset(*self.get_tensors(data, delta=self.params_d["forecast_delta"]))
+		return TensorDataset(*self.get_tensors(data[:4], delta=self.params_d["forecast_delta"]))
 
 	def get_meta_dataset(self, data, split):
 		"""
@@ -217,18 +763,30 @@ class XGDataModule(pl.LightningDataModule):
 			* n: meta dataset size (number of episodes)
 			* e: episode size (number of observations)
 			* *: observation dimensions
+
+		Only the base tensors and the (ctx, tgt) index matrices are stored,
+		episodes are gathered on demand (see EpisodeDataset).
+		Context resampling is applied per batch as it is fetched, so it is redrawn every epoch.
 		"""
-		i, f, t, r = self.get_tensors(data, delta=self.params_d["forecast_delta"])
-		train_mode = split=='train'
-		step_size = self.params_d['step_size'] if (train_mode) else self.params_d['context_size']
-		ctx, tgt = windowed_ctx_tgt(
+		i, f, t, r, l = self.get_tensors(data, delta=self.params_d["forecast_delta"])
+		ctx, tgt = self.get_episode_index(i, split, self.params_d)
+		return EpisodeDataset(i, f, t, r, l, ctx, tgt,
+			resample_context=self.params_d['resample_context'] and split=='train',
+			target_stats=self.standardize("target") if (self.params_d["standardize"]) else None)
+
+	@staticmethod
+	def get_episode_index(i, split, params, start_step=0):
+		"""
+		Context and target index matrices of the episodes over i, starting from episode start_step.
+		Training episodes step by step_size, evaluation episodes don't overlap (step by context_size).
+		"""
+		step_size = params['step_size'] if (split=='train') else params['context_size']
+		return windowed_ctx_tgt(
 			i,
-			self.params_d['context_size'],
-			self.params_d['target_size'],
-			step_size or self.params_d['context_size'],
-			self.params_d['overlap_size'],
-			self.params_d['resample_context'] and train_mode
+			params['context_size'],
+			params['target_size'],
+			step_size or params['context_size'],
+			params['overlap_size'],
+			start_step=start_step
 		)
-		assert len(ctx)==len(tgt)
-		return TensorDataset(i[ctx], f[ctx], t[ctx], r[ctx], i[tgt], f[tgt], t[tgt], r[tgt])
 
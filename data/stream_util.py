@@ -0,0 +1,135 @@
+import sys
+import os
+import math
+import logging
+from copy import copy
+
+import numpy as np
+import torch
+
+from common_util import load_arrow_np, np_ragged_vstack_2d, np_day_lengths, isnt
+from data.window_util import windowed_ctx_tgt, WindowedDataset, EpisodeDataset
+
+
+class StreamEpisodeDataset(torch.utils.data.IterableDataset):
+	"""
+	Streaming (out of core) episodic dataset.
+	Yields the same batches as an EpisodeDataset built over the same split and read by the
+	XGDataModule dataloader, as the tuple (ic, xc, yc, zc, lc, it, xt, yt, zt, lt), but the features
+	are streamed day by day from the memory mapped arrow files instead of being held in memory.
+
+	The batches are built in chunks of chunk_batches batches, only the days a chunk's episodes
+	span (plus the window and forecast delta lookahead) are read, by their date range (see load_arrow_np),
+	so memory is bounded by the chunk size and not the length of the history. Shuffling permutes
+	the episodes within each chunk, so a larger chunk_batches gives a better shuffle at the cost of a larger buffer.
+	Worker processes of a DataLoader each read and yield every num_workers-th chunk only.
+
+	The per day index, target, and return arrays are small and held in memory.
+
+	Args:
+		feature_dir (str): directory of the feature arrow files
+		feature_names (list): feature file names, one per channel
+		day_size (int): number of rows per day in the feature files
+		index (np.array): datetime index of each day shaped (n,)
+		t (np.array): target of each day shaped (n,)
+		r (np.array): return of each day shaped (n,)
+		window_size (int): number of days in each feature window
+		forecast_delta (int): number of days the labels are shifted forward
+		context_size (int): episode context size
+		target_size (int): episode target size
+		step_size (int): step between episodes
+		overlap_size (int): context/target overlap
+		batch_size (int): number of episodes per batch (the last partial batch is dropped)
+		resample_context (bool): resample the context of each episode as it is fetched
+		target_stats (tuple|None): (loc, scale) the target is standardized by
+		shuffle (bool): shuffle the episodes within each chunk
+		chunk_batches (int): number of batches built from each buffered chunk of days
+		feature_dtype (torch.dtype): dtype the buffered feature days are held in
+		fields (tuple|None): names of the fields to gather, see EpisodeDataset
+	"""
+	def __init__(self, feature_dir, feature_names, day_size, index, t, r, window_size, forecast_delta,
+		context_size, target_size, step_size, overlap_size, batch_size,
+		resample_context=False, target_stats=None, shuffle=False, chunk_batches=1, feature_dtype=torch.float32,
+		fields=None):
+		super().__init__()
+		self.feature_dir = feature_dir
+		self.feature_names = feature_names
+		self.day_size = day_size
+		self.days = index.astype('datetime64[D]')
+		self.t, self.r = t, r
+		self.window_size = window_size
+		self.forecast_delta = forecast_delta
+		self.context_size = context_size
+		self.target_size = target_size
+		self.step_size = step_size
+		self.overlap_size = overlap_size
+		self.batch_size = batch_size
+		self.resample_context = resample_context
+		self.target_stats = target_stats
+		self.shuffle = shuffle
+		self.chunk_batches = chunk_batches
+		self.feature_dtype = feature_dtype
+		self.fields = fields
+
+		self.lookahead = window_size - 1 + forecast_delta
+		self.episode_size = context_size + target_size
+		n_obs = max(len(t) - self.lookahead, 0)
+		n_episodes = max((n_obs - self.episode_size)//step_size + 1, 0)
+		self.n_batches = n_episodes // batch_size
+
+	def __len__(self):
+		return self.n_batches
+
+	def with_fields(self, fields):
+		view = copy(self)
+		view.fields = fields
+		return view
+
+	def read_days(self, day_lo, day_hi):
+		"""
+		Read the days [day_lo, day_hi) of all feature channels, shaped (days, C, H, W),
+		and the valid length of each day (see np_day_lengths).
+		Only the rows in their date range are read and decoded, short days are NaN padded.
+		"""
+		dt_range = (self.days[day_lo], self.days[day_hi] if (day_hi < len(self.days)) else None)
+		chans = []
+		for name in self.feature_names:
+			col = load_arrow_np(name, self.feature_dir, dt_range=dt_range)
+			idx = col.pop('datetime')
+			chans.append(np_ragged_vstack_2d(list(col.values()), idx, self.day_size))
+		return np.stack(chans, axis=1), np_day_lengths(idx, self.day_size)
+
+	def get_chunk(self, days, lengths, obs_lo, obs_hi):
+		"""
+		EpisodeDataset over the observations [obs_lo, obs_hi) of the split, days (and their lengths) hold
+		the days from obs_lo up to the last day the observations look ahead to.
+		"""
+		f = torch.tensor(days, dtype=self.feature_dtype)
+		l = torch.from_numpy(lengths).unfold(0, self.window_size, 1)[:obs_hi-obs_lo]
+		i = torch.arange(obs_lo, obs_hi)
+		t = torch.tensor(self.t[obs_lo+self.lookahead:obs_hi+self.lookahead], dtype=torch.float32)
+		r = torch.tensor(self.r[obs_lo+self.lookahead:obs_hi+self.lookahead], dtype=torch.float32)
+		ctx, tgt = windowed_ctx_tgt(torch.arange(obs_hi-obs_lo), self.context_size, self.target_size,
+			self.step_size, self.overlap_size)
+		return EpisodeDataset(i, WindowedDataset(f, self.window_size), t, r, l, ctx, tgt,
+			resample_context=self.resample_context, target_stats=self.target_stats, fields=self.fields)
+
+	def __iter__(self):
+		info = torch.utils.data.get_worker_info()
+		worker_id, num_workers = (0, 1) if (isnt(info)) else (info.id, info.num_workers)
+
+		for c in range(worker_id, math.ceil(self.n_batches / self.chunk_batches), num_workers):
+			b_lo, b_hi = c*self.chunk_batches, min((c+1)*self.chunk_batches, self.n_batches)
+			obs_lo = b_lo*self.batch_size*self.step_size
+			obs_hi = (b_hi*self.batch_size-1)*self.step_size + self.episode_size
+			day_hi = obs_hi + self.lookahead
+
+			days, lengths = self.read_days(obs_lo, day_hi)
+			if (len(days) < day_hi - obs_lo):
+				logging.warning(f"{self.feature_dir} ends before the target index, stopping the stream")
+				return
+
+			chunk = self.get_chunk(days, lengths, obs_lo, obs_hi)
+			order = torch.randperm(len(chunk)) if (self.shuffle) else torch.arange(len(chunk))
+			for idx in order.split(self.batch_size):
+				yield chunk[idx]
@@ -0,0 +1,201 @@
+"""
+Data module smoke tests, run by smoke-xgdm.sh (python3 -m data.test_xgdm [test names]).
+The tests build their data modules over the source files under DATA_DIR,
+a failed check raises an AssertionError.
+"""
+import sys
+import os
+import tempfile
+import logging
+
+import numpy as np
+import torch
+import pyarrow.feather as pf
+
+from common_util import benchmark, load_arrow_table, makedir_if_not_exists
+from data.common import dum
+from data.cache_util import ArtifactCache
+from data.pl_xgdm import XGDataModule
+from data.pl_mxgdm import MultiXGDataModule
+
+
+PARAMS_D = {
+	"forecast_delta": 1, "standardize": True, "window_size": 3,
+	"context_size": 3, "target_size": 2, "step_size": 1, "overlap_size": 1, "resample_context": False,
+	"batch_size": 1, "shuffle": False, "num_workers": 0, "pin_memory": False
+}
+FEATURE_NAME = "logchangeprice,logchangeivol"
+ASSET_NAMES = ("SPX", "RUT")
+
+def test_pooled_pred(asset_names=ASSET_NAMES, splits=("train", "val")):
+	"""
+	Predictions of a pooled multi asset loader are dumped end to end, and each asset's
+	predictions match the ones over that asset's own loader (same dates, targets, outputs).
+	"""
+	from model.pl_np import NPModel
+	from model.np_util import AttentiveNP
+	from model.exp_util import dump_pred
+
+	dm = MultiXGDataModule(dict(PARAMS_D), asset_names=asset_names, feature_name=FEATURE_NAME, use_cache=False)
+	dm.prepare_data()
+	dm.setup()
+	params_m = {"loss": "reg-dnll", "in_params": {}, "ft_params": {"collapse_out": True},
+		"use_det_path": False, "use_lat_path": False, "masked": dm.is_padded()}
+	model = NPModel(AttentiveNP, params_m, dm.params_d, dm.get_fshape(), splits)
+	with tempfile.TemporaryDirectory() as trial_dir:
+		dfs_pred = dump_pred(trial_dir +os.sep, "anp", "base", splits, dm, model)
+		assert all(os.path.exists(f"{trial_dir}{os.sep}plot_{split}_pred_{name}.png")
+			for split in splits for name in dm.asset_names)
+
+	cols = ["yt", "yc", "pred_mean", "pred_std"]
+	for split, df_pred in dfs_pred.items():
+		assert df_pred.index.isin(dm.index[split]).all()
+		for asset, name in enumerate(dm.asset_names):
+			df_asset = df_pred.loc[df_pred["asset"] == asset]
+			df_ref = model.pred_df(dm.get_dataloader(split, asset_name=name, fields=model.EVAL_FIELDS), dm.index[split])
+			assert df_asset.index.equals(df_ref.index), f"{split} {name}: predicted dates differ"
+			assert np.allclose(df_asset[cols].values, df_ref[cols].values, atol=1e-5), f"{split} {name}: predictions differ"
+			assert (df_asset["ic"] == df_ref["ic"]).all()
+
+def write_sources(dm, ddir, ends=None):
+	"""
+	Copy the source files of dm to ddir, the files of each split in ends are cut before its end date.
+	"""
+	ends = ends or {}
+	for path in dm.get_source_paths():
+		split = path[len(dm.ddir):].split("/")[1]
+		dst = ddir +path[len(dm.ddir):]
+		makedir_if_not_exists(os.path.dirname(dst))
+		pf.write_feather(load_arrow_table(path, dt_range=(None, ends.get(split))), dst, compression="uncompressed")
+
+def assert_same_data(dm, ref, params_list):
+	for split in dm.SPLITS:
+		for kind in dm.KINDS:
+			assert np.array_equal(dm.data[[split, kind]], ref.data[[split, kind]], equal_nan=True), f"{split} {kind} differ"
+	assert np.allclose(dm.standardize("target"), ref.standardize("target"))
+	for params in params_list:
+		dm.update(dict(params))
+		ref.update(dict(params))
+		for split in dm.SPLITS:
+			assert np.array_equal(dm.index[split], ref.index[split]), f"{split} index differs"
+			a, b = dm.dataset[split], ref.dataset[split]
+			assert len(a) == len(b), f"{split} episodes differ"
+			idx = torch.arange(len(b))
+			assert all(torch.allclose(x.double(), y.double(), atol=1e-6, equal_nan=True)
+				for x, y in zip(a[idx], b[idx]) if (x is not None)), f"{split} episodes differ"
+			assert sum(1 for _ in dm.get_dataloader(split)) == sum(1 for _ in ref.get_dataloader(split))
+
+def test_ingest(asset_name=ASSET_NAMES[0], slices=(4, 2), splits=("train", "test")):
+	"""
+	A data module ingesting two slices of new days into splits (its data, memoized windows and episodes,
+	standardization statistics, and cached artifacts) matches one set up over all of the days.
+	"""
+	params_list = [PARAMS_D, dict(PARAMS_D, window_size=2, context_size=4, target_size=3)]
+	src = XGDataModule(dict(PARAMS_D), asset_name=asset_name, feature_name=FEATURE_NAME, use_cache=False)
+	days = {split: np.unique(src.read_target(split).index.to_numpy().astype("datetime64[D]")) for split in splits}
+	cuts = [{split: days[split][-k] for split in splits} for k in slices] + [None]
+
+	with tempfile.TemporaryDirectory() as tmp:
+		ddir = f"{tmp}{os.sep}{asset_name}"
+		def make(use_cache):
+			dm = XGDataModule(dict(PARAMS_D), asset_name=asset_name, feature_name=FEATURE_NAME, use_cache=use_cache)
+			dm.ddir = ddir
+			dm.cache = dm.data_cache = ArtifactCache(f"{tmp}{os.sep}cache")
+			return dm
+
+		write_sources(src, ddir, cuts[0])
+		dm = make(use_cache=True)
+		dm.prepare_data()
+		dm.setup()
+		for params in params_list:
+			dm.update(dict(params))
+		for cut in cuts[1:]:
+			write_sources(src, ddir, cut)
+			for split in splits:
+				assert dm.ingest(split) > 0, f"{split}: no days ingested"
+				assert dm.ingest(split) == 0, f"{split}: days ingested twice"
+
+		ref = make(use_cache=False)
+		ref.prepare_data()
+		ref.setup()
+		assert_same_data(dm, ref, params_list)
+
+		reload = make(use_cache=True)
+		reload.prepare_data()
+		reload.setup()
+		assert_same_data(reload, ref, params_list)
+
+def test_stream(asset_name=ASSET_NAMES[0], num_workers=(0, 2)):
+	"""
+	A streaming data module yields the same batches as an in memory one, in order,
+	with one or more DataLoader workers each reading only their own chunks.
+	"""
+	ref = XGDataModule(dict(PARAMS_D), asset_name=asset_name, feature_name=FEATURE_NAME, use_cache=False)
+	ref.prepare_data()
+	ref.setup()
+	for n in num_workers:
+		dm = XGDataModule(dict(PARAMS_D, num_workers=n), asset_name=asset_name, feature_name=FEATURE_NAME, stream=True)
+		dm.prepare_data()
+		dm.setup()
+		for split in dm.SPLITS:
+			a, b = list(dm.get_dataloader(split)), list(ref.get_dataloader(split))
+			assert len(a) == len(b), f"{split} ({n} workers): batches differ"
+			assert all(torch.equal(x, y) for p, q in zip(a, b) for x, y in zip(p, q)), f"{split} ({n} workers): batches differ"
+
+def test_padding(asset_name=ASSET_NAMES[0]):
+	"""
+	The input mask built from the day lengths of the episodes (lc, lt) only masks the NaN padding of short days.
+	"""
+	from model.np_util import AttentiveNP
+
+	dm = XGDataModule(dict(PARAMS_D), asset_name=asset_name, feature_name=FEATURE_NAME, use_cache=False)
+	dm.prepare_data()
+	dm.setup()
+	for split in dm.SPLITS:
+		assert dm.has_padding(dm.data[[split, "length"]]) == bool(np.isnan(dm.data[[split, "feature"]]).any())
+		for ic, xc, yc, zc, lc, it, xt, yt, zt, lt in dm.get_dataloader(split):
+			for x, l in ((xc, lc), (xt, lt)):
+				_, mask = AttentiveNP.fill_padding(x, l)
+				assert torch.isnan(x[~mask]).all(), f"{split}: valid positions are masked"
+
+def test_memo(asset_name=ASSET_NAMES[0], window_sizes=(1, 2, 3, 4, 2)):
+	"""
+	Sweeping params keeps the memoized setup stages bounded (see MEMO_SIZES),
+	and re-setting up evicted params matches a fresh data module. A feature_dtype change is rejected.
+	"""
+	dm = XGDataModule(dict(PARAMS_D), asset_name=asset_name, feature_name=FEATURE_NAME, use_cache=False)
+	dm.prepare_data()
+	dm.setup()
+	params_list = [dict(PARAMS_D, window_size=w) for w in window_sizes]
+	for params in params_list:
+		dm.update(dict(params))
+		for split in dm.SPLITS:
+			dm.get_dataloader(split)
+		assert all(len(dm.memo.get(stage, {})) <= size for stage, size in dm.MEMO_SIZES.items()), "memo grew past MEMO_SIZES"
+	try:
+		dm.update(dict(PARAMS_D, feature_dtype="float16"))
+		assert False, "feature_dtype changed by update()"
+	except ValueError:
+		pass
+	ref = XGDataModule(dict(PARAMS_D), asset_name=asset_name, feature_name=FEATURE_NAME, use_cache=False)
+	ref.prepare_data()
+	ref.setup()
+	assert_same_data(dm, ref, params_list[:1])
+
+TESTS = {
+	"pooled_pred": test_pooled_pred,
+	"ingest": test_ingest,
+	"stream": test_stream,
+	"padding": test_padding,
+	"memo": test_memo
+}
+
+def test_xgdm(argv):
+	names = argv or list(TESTS)
+	for name in names:
+		with benchmark(name, suppress=True) as b:
+			TESTS[name]()
+		logging.info(f"{name}: ok ({b.delta.total_seconds():.3f}s)")
+
+if __name__ == '__main__':
+	test_xgdm(sys.argv[1:])
@@ -2,13 +2,19 @@ import sys
 import os
 import math
 import logging
+import queue
+import threading
+import atexit
+import weakref
+from copy import copy
+from functools import partial
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
-import more_itertools
 import torch
 
-from common_util import window_iter, trunc_step_window_iter, pt_random_choice
+from common_util import is_type, is_valid, isnt
 from data.common import dum
 
 
@@ -30,6 +36,14 @@ def overlap_win_preproc_3d(data, window_size, same_dims=True):
 				2 | g h i      2 | d e f g h i
 				3 | j k l      3 | g h i j k l
 
+	Note the window is the innermost axis, so flattening interleaves the rows of a window
+	(index w*window_size + k holds element w of the k-th row in the window).
+
+	The windows are built as a strided view of the input, without a python loop or copy.
+	If same_dims is not set (or the view can be flattened without a copy) the returned
+	array is that read only view, use np.array(...) on it to materialize the windows.
+	Otherwise flattening materializes the windowed tensor in a single copy.
+
 	Args:
 		data (tuple): tuple of numpy arrays
 		window_size (int): desired size of window (history length)
@@ -43,8 +57,8 @@ def overlap_win_preproc_3d(data, window_size, same_dims=True):
 
 	for i, d in enumerate(data):
 		if (d.ndim > 1):
-			pp = np.array([np.stack(w, axis=-1) for w in window_iter(d, n=window_size)])
-			pp = pp.reshape(*pp.shape[:-2], np.product(pp.shape[-2:])) if (same_dims) else pp
+			pp = sliding_window_view(d, window_size, axis=0)	# (N, ..., W) -> (N-window_size+1, ..., W, window_size)
+			pp = pp.reshape(*pp.shape[:-2], np.prod(pp.shape[-2:])) if (same_dims) else pp
 		else:
 			pp = d[window_size-1:] # Realign by dropping observations prior to the first step
 		preproc.append(pp)
@@ -82,19 +96,231 @@ def stride_win_preproc_3d(data, window_size):
 
 	return tuple(preproc)
 
-def windowed_ctx_tgt(x, context_size, target_size, step_size=1, overlap_size=0, resample_context=False):
+class WindowedDataset(torch.utils.data.Dataset):
+	"""
+	Lazy overlapping window dataset.
+	Stands in for the tensor overlap_win_preproc_3d(..., same_dims=True) returns,
+	shaped (N-window_size+1, C, H, W*window_size), while only holding the base
+	tensor shaped (N, C, H, W) in memory. Windows are gathered from the base when indexed.
+
+	Args:
+		base (torch.tensor): base tensor shaped (N, C, H, W)
+		window_size (int): desired size of window (history length)
+
+	Supports indexing by:
+		* int: returns one window shaped (C, H, W*window_size)
+		* slice (step 1): returns a WindowedDataset over a view of the base
+		* integer tensor: returns a tensor shaped (*idx.shape, C, H, W*window_size),
+			built with a single gather from the base
+	"""
+	def __init__(self, base, window_size):
+		super().__init__()
+		self.base = base
+		self.window_size = window_size
+		self.offsets = torch.arange(window_size)
+		self.shape = (max(len(base)-window_size+1, 0), *base.shape[1:-1], base.shape[-1]*window_size)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def __getitem__(self, idx):
+		if (is_type(idx, slice)):
+			start, stop, step = idx.indices(len(self))
+			assert step == 1, "only contiguous slices are supported"
+			return WindowedDataset(self.base[start:max(start, stop)+self.window_size-1], self.window_size)
+
+		idx = torch.as_tensor(idx)
+		idx = torch.where(idx < 0, idx + len(self), idx)
+		win = self.base[idx.unsqueeze(-1) + self.offsets]	# [*idx, window_size, C, H, W]
+		win = win.movedim(idx.ndim, -1)				# [*idx, C, H, W, window_size]
+		return win.reshape(*win.shape[:-2], -1)			# [*idx, C, H, W*window_size]
+
+EPISODE_FIELDS = ("ic", "xc", "yc", "zc", "lc", "it", "xt", "yt", "zt", "lt")
+
+class EpisodeDataset(torch.utils.data.Dataset):
+	"""
+	Index based episodic (meta) dataset.
+	Holds each base tensor once along with the context and target index matrices,
+	episodes are gathered from the base tensors when indexed instead of storing
+	a copy of every observation for each episode it appears in.
+
+	Args:
+		i (torch.tensor): index tensor shaped (n,)
+		f (torch.tensor|WindowedDataset): feature tensor shaped (n, C, H, W)
+		t (torch.tensor): target tensor shaped (n,)
+		r (torch.tensor): return tensor shaped (n,)
+		l (torch.tensor): valid length of each day in the window of each feature, shaped (n, window_size),
+			the positions of a day from its length on are padding (see np_day_lengths)
+		ctx (torch.tensor): context index matrix shaped (m, context_size)
+		tgt (torch.tensor): target index matrix shaped (m, target_size+overlap_size)
+
+		resample_context (bool): whether to resample (bootstrap) the context of each episode
+			every time it is fetched, so each epoch sees a fresh draw
+		target_stats (tuple|None): (loc, scale) the target is standardized by as it is fetched,
+			the base target tensor is left unchanged
+		fields (tuple|None): names of the fields to gather (see EPISODE_FIELDS), the others are None
+			in the returned tuple, if None all fields are gathered
+
+	Features stored in a 16 bit dtype (float16, bfloat16) are upcast to float32 per batch as they are gathered.
+
+	Indexing by an episode index returns one episode, indexing by a list/tensor
+	of episode indices returns a whole batch (one gather per tensor), as the tuple
+		(ic, xc, yc, zc, lc, it, xt, yt, zt, lt)
+	where each element is shaped ([b,] e, *).
+	"""
+	def __init__(self, i, f, t, r, l, ctx, tgt, resample_context=False, target_stats=None, fields=None):
+		super().__init__()
+		assert len(ctx)==len(tgt)
+		assert isnt(fields) or set(fields) <= set(EPISODE_FIELDS)
+		self.base = (i, f, t, r, l)
+		self.ctx, self.tgt = ctx, tgt
+		self.resample_context = resample_context
+		self.target_stats = target_stats
+		self.fields = fields
+
+	def __len__(self):
+		return len(self.ctx)
+
+	def __getitem__(self, idx):
+		return self.get_batch(idx)
+
+	def get_batch(self, idx, generator=None):
+		"""
+		Episodes at idx, the contexts are resampled with generator (the global RNG if None).
+		"""
+		ctx, tgt = self.ctx[idx], self.tgt[idx]
+		if (self.resample_context):
+			ctx = resample_ctx(ctx, generator=generator)
+		return self.gather(ctx, EPISODE_FIELDS[:5]) + self.gather(tgt, EPISODE_FIELDS[5:])
+
+	def with_fields(self, fields):
+		"""
+		Shallow copy of the dataset that only gathers fields, the base tensors and index matrices are shared.
+		"""
+		assert set(fields) <= set(EPISODE_FIELDS)
+		view = copy(self)
+		view.fields = fields
+		return view
+
+	def extend(self, base, ctx, tgt):
+		"""
+		Swap in the (appended to) base tensors and add the episodes built over the new rows.
+		"""
+		assert len(ctx)==len(tgt)
+		self.base = base
+		self.ctx, self.tgt = torch.cat([self.ctx, ctx]), torch.cat([self.tgt, tgt])
+
+	def gather(self, idx, names):
+		"""
+		Gather (i, f, t, r, l) at the index matrix idx, standardizing the target if target_stats is set.
+		The fields whose names are not in self.fields are not gathered and returned as None.
+		"""
+		i, f, t, r, l = (x[idx] if (isnt(self.fields) or name in self.fields) else None
+			for x, name in zip(self.base, names))
+		if (is_valid(f) and f.dtype in (torch.float16, torch.bfloat16)):
+			f = f.float()
+		if (is_valid(t) and is_valid(self.target_stats)):
+			loc, scale = self.target_stats
+			t = (t - loc) / scale
+		return i, f, t, r, l
+
+class PooledEpisodeDataset(torch.utils.data.Dataset):
+	"""
+	Pools equally sized episodic datasets (one per asset) into one,
+	episode k is episode k % m of dataset k // m (where m is the length of each dataset).
+
+	A batch is gathered with one batched fetch per dataset it draws from and returned in the
+	requested order, so batches mix assets and go through the model in one forward pass.
+	The row indices (ic, it) of each dataset are offset by the rows of the datasets before it,
+	so they identify the rows of the pool (see get_row) and no two assets share a row index.
+
+	Args:
+		datasets (list): EpisodeDatasets of the same length
+	"""
+	def __init__(self, datasets):
+		super().__init__()
+		assert all(len(d)==len(datasets[0]) for d in datasets)
+		self.datasets = datasets
+
+	@property
+	def size(self):
+		return len(self.datasets[0])
+
+	def __len__(self):
+		return self.size * len(self.datasets)
+
+	def get_asset(self, idx):
+		"""
+		Dataset (asset) number of each episode index.
+		"""
+		return torch.as_tensor(idx) // self.size
+
+	def get_offsets(self):
+		"""
+		Pooled row index of the first row of each dataset.
+		"""
+		rows = torch.tensor([len(d.base[0]) for d in self.datasets])
+		return torch.cumsum(rows, 0) - rows
+
+	def get_row(self, i):
+		"""
+		Dataset (asset) number and row index within it of each pooled row index (ic, it) in i.
+		"""
+		offsets = self.get_offsets()
+		asset = torch.searchsorted(offsets, torch.as_tensor(i), right=True) - 1
+		return asset, i - offsets[asset]
+
+	def __getitem__(self, idx):
+		return self.get_batch(idx)
+
+	def get_batch(self, idx, generator=None):
+		idx = torch.arange(len(self))[idx] if (is_type(idx, slice)) else torch.as_tensor(idx)
+		flat = torch.where(idx < 0, idx + len(self), idx).reshape(-1)
+		asset, episode = flat // self.size, flat % self.size
+		order = torch.argsort(asset, stable=True)
+		offsets = self.get_offsets().tolist()
+		groups = [self.offset_rows(self.datasets[a].get_batch(episode[asset==a], generator), offsets[a])
+			for a in asset.unique().tolist()]
+		restore = torch.argsort(order)
+		return tuple(None if (field[0] is None) else torch.cat(field)[restore].reshape(*idx.shape, *field[0].shape[1:])
+			for field in zip(*groups))
+
+	@staticmethod
+	def offset_rows(batch, offset):
+		return tuple(field + offset if (name in ("ic", "it") and is_valid(field)) else field
+			for name, field in zip(EPISODE_FIELDS, batch))
+
+	def with_fields(self, fields):
+		return PooledEpisodeDataset([d.with_fields(fields) for d in self.datasets])
+
+def resample_ctx(ctx, generator=None):
+	"""
+	Resample (with replacement) the context index matrix along its last dimension,
+	all rows are drawn with a single batched call (from generator, the global RNG if None).
+	"""
+	return ctx.gather(-1, torch.randint(ctx.shape[-1], ctx.shape, generator=generator))
+
+def windowed_ctx_tgt(x, context_size, target_size, step_size=1, overlap_size=0, resample_context=False, start_step=0):
 	"""
 	Split into context and target sets by sliding window,
 	context is the head and target is the tail.
+	Windows before start_step are skipped, so the windows an append to x adds can be built on their own.
+
+	All window index matrices are built at once by broadcasting the window starts against
+	the window offsets, resampled contexts (bootstrap, with replacement) are drawn in one
+	batched call, so the number of tensor operations doesn't depend on len(x).
+
+	Returns:
+		context and target tensors shaped (m, context_size, *) and (m, target_size+overlap_size, *)
 	"""
-	contexts, targets = [], []
-	for obs in trunc_step_window_iter(x, n=context_size+target_size, step=step_size):
-		cpoints = obs[:context_size]
-		if (resample_context):
-			cpoints = pt_random_choice(cpoints, replacement=True)
-		contexts.append(cpoints)
-		targets.append(obs[context_size-overlap_size:])
-	return torch.stack(contexts), torch.stack(targets)
+	n = context_size + target_size
+	n_steps = max(((len(x)-n)//step_size)+1, 0)
+	win = (torch.arange(min(start_step, n_steps), n_steps) * step_size).unsqueeze(-1) + torch.arange(n)	# [m, n]
+	ctx = win[:, :context_size]
+	if (resample_context):
+		ctx = resample_ctx(ctx)
+	tgt = win[:, context_size-overlap_size:]
+	return x[ctx], x[tgt]
 
 def get_np_collate_fn(context_size, target_size, step_size=1, overlap_size=0, resample_context=False):
 	"""
@@ -111,45 +337,180 @@ def get_np_collate_fn(context_size, target_size, step_size=1, overlap_size=0, re
 		return i[ctx], x[ctx], y[ctx], z[ctx], i[tgt], x[tgt], y[tgt], z[tgt]
 	return np_collate_fn
 
+class BatchLoader:
+	"""
+	Bulk batch loader for datasets that are indexed by a whole batch at once (EpisodeDataset, PooledEpisodeDataset).
+	Each batch is a single indexing of the dataset, by a contiguous slice of the episodes in order,
+	or by a slice of a random permutation if shuffle is set, so there are no per item fetches and no collate.
+
+	Batches are built ahead on a background thread (up to prefetch batches, pinned if pin_memory is set),
+	torch releases the GIL while it gathers so the next batch is built during the current training step.
+	The shuffle and context resampling of each pass draw from their own generator, seeded from the global RNG
+	when the pass starts, so seeded runs are reproducible whatever the producer thread interleaves with.
+
+	Args:
+		dataset (torch.utils.data.Dataset): dataset indexable by a slice or a tensor of indices,
+			its get_batch(idx, generator) is used instead if it has one
+		batch_size (int): number of episodes per batch
+		shuffle (bool): draw the batches from a new random permutation every epoch
+		drop_last (bool): drop the last batch if it is smaller than batch_size
+		pin_memory (bool): pin the batches in page locked memory
+		prefetch (int): number of batches built ahead, if 0 the batches are built in the calling thread
+	"""
+	DONE = object()
+	producers = weakref.WeakKeyDictionary() # running producer thread -> stop event, stopped at exit
+
+	def __init__(self, dataset, batch_size, shuffle=False, drop_last=True, pin_memory=False, prefetch=2):
+		self.dataset = dataset
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		self.drop_last = drop_last
+		self.pin_memory = pin_memory and torch.cuda.is_available()
+		self.prefetch = prefetch
+		if (pin_memory and not self.pin_memory):
+			logging.warning("pin_memory is set but no accelerator is available, batches won't be pinned")
+
+	def __len__(self):
+		n = len(self.dataset)
+		return n // self.batch_size if (self.drop_last) else math.ceil(n / self.batch_size)
+
+	def __iter__(self):
+		generator = torch.Generator()
+		generator.manual_seed(torch.empty((), dtype=torch.int64).random_().item())
+		return self.get_batches(generator) if (self.prefetch < 1) else self.prefetch_batches(generator)
+
+	def get_batches(self, generator=None):
+		perm = torch.randperm(len(self.dataset), generator=generator) if (self.shuffle) else None
+		fetch = partial(self.dataset.get_batch, generator=generator) if (hasattr(self.dataset, "get_batch")) \
+			else self.dataset.__getitem__
+		for b in range(len(self)):
+			idx = slice(b*self.batch_size, (b+1)*self.batch_size)
+			batch = fetch(idx if (perm is None) else perm[idx])
+			if (self.pin_memory):
+				batch = tuple(x if (x is None) else x.pin_memory() for x in batch)
+			yield batch
+
+	def prefetch_batches(self, generator=None):
+		q, stop = queue.Queue(self.prefetch), threading.Event()
+
+		def put(item):
+			while (not stop.is_set()):
+				try:
+					q.put(item, timeout=.1)
+					return True
+				except queue.Full:
+					continue
+			return False
+
+		def produce():
+			try:
+				for batch in self.get_batches(generator):
+					if (not put(batch)):
+						return
+				put(self.DONE)
+			except Exception as e:
+				put(e)
+
+		thread = threading.Thread(target=produce, daemon=True)
+		self.producers[thread] = stop
+		thread.start()
+		try:
+			while ((item := q.get()) is not self.DONE):
+				if (isinstance(item, Exception)):
+					raise item
+				yield item
+		finally:
+			stop.set()
+
+@atexit.register
+def stop_batch_loaders():
+	"""
+	Stop the prefetch threads of unfinished BatchLoader iterators before the interpreter exits.
+	"""
+	for thread, stop in list(BatchLoader.producers.items()):
+		stop.set()
+		thread.join(timeout=1)
+
 class WindowBatchSampler(torch.utils.data.Sampler):
 	"""
 	Pytorch Batch Sampler for Sequential window sampling.
 	Can be used with a pytorch DataLoader to sample batches from a dataset
 	as sequential moving windows.
 
+	All batch windows are built at once as an integer tensor shaped (num_windows, batch_size),
+	the remainder methods are applied to it without any python level padding:
+		* trunc: drop the windows that run past the end of the data
+		* ffill: clamp the indices past the end of the data to the last index
+		* nfill: trim the indices past the end of the data (the last batch is smaller)
+
+	Shuffling permutes the batch order every epoch (seeded by seed + epoch, see set_epoch),
+	the batches themselves stay sequential windows. For multi process training the batches
+	are sharded by rank (each replica gets every num_replicas-th batch of the epoch order),
+	padding with the first batches so every replica gets the same number of batches.
+
 	Args:
 		data_source (Dataset): dataset to sample from
 		batch_size (int>=1): batch window size
 		batch_step_size (None or int>=1): step size (distance between adjacent batches)
 		batch_shuffle (bool): whether to shuffle the batch order
 		method: how to deal with remainder
+		seed (int): shuffle seed, must be the same on all replicas
+		num_replicas (int): number of processes to shard the batches over,
+			defaults to the torch.distributed world size
+		rank (int): rank of this process, defaults to the torch.distributed rank
 	"""
 
 	def __init__(self, data_source, batch_size=128, batch_step_size=None, \
-		method='trunc', batch_shuffle=False):
-		super().__init__(data_source)
+		method='trunc', batch_shuffle=False, seed=0, num_replicas=None, rank=None):
 		self.data_source = data_source
 		self.batch_size = batch_size
 		self.batch_step_size = batch_step_size or batch_size
 		self.batch_shuffle = batch_shuffle
 		self.method = method
+		self.seed = seed
+		self.epoch = 0
+		dist = torch.distributed.is_available() and torch.distributed.is_initialized()
+		self.num_replicas = num_replicas or (torch.distributed.get_world_size() if (dist) else 1)
+		self.rank = rank if (is_valid(rank)) else (torch.distributed.get_rank() if (dist) else 0)
+		assert method in ('trunc', 'ffill', 'nfill'), "method must be one of 'trunc', 'ffill', 'nfill'"
+		assert 0 <= self.rank < self.num_replicas
 		assert len(self.data_source) >= self.batch_size, "must have at least one batch"
 
-	def __iter__(self):
-		if (self.method == 'ffill'):
-			iterable = more_itertools.windowed(range(len(self.data_source)), \
-					n=self.batch_size, step=self.batch_step_size, fillvalue=-1)
-		elif (self.method == 'nfill'):
-			iterable = more_itertools.windowed(range(len(self.data_source)), \
-				n=self.batch_size, step=self.batch_step_size, fillvalue=None)
-		elif (self.method == 'trunc'):
-			iterable = more_itertools.windowed(range(self.get_data_end()), \
-				n=self.batch_size, step=self.batch_step_size, fillvalue=None)
+	def set_epoch(self, epoch):
+		"""
+		Set the epoch the batch order is shuffled for (call at the start of every epoch).
+		"""
+		self.epoch = epoch
+
+	def get_windows(self):
+		"""
+		Index windows of all batches in sequential order, shaped (num_windows, batch_size).
+		"""
+		starts = torch.arange(self.get_num_windows()) * self.batch_step_size
+		windows = starts.unsqueeze(-1) + torch.arange(self.batch_size)
+		return windows.clamp(max=len(self.data_source)-1) if (self.method == 'ffill') else windows
 
+	def get_order(self):
+		"""
+		Batch order of this replica for the current epoch.
+		"""
+		n = self.get_num_windows()
 		if (self.batch_shuffle):
-			raise NotImplementedError("Need to add ability to shuffle batches")
+			order = torch.randperm(n, generator=torch.Generator().manual_seed(self.seed + self.epoch))
+		else:
+			order = torch.arange(n)
+		total = math.ceil(n / self.num_replicas) * self.num_replicas
+		order = torch.cat([order, order[:total-n]]) if (total > n) else order
+		return order[self.rank::self.num_replicas]
+
+	def __iter__(self):
+		windows, n = self.get_windows(), len(self.data_source)
+		for w in self.get_order().tolist():
+			window = windows[w]
+			yield (window[window < n] if (self.method == 'nfill') else window).tolist()
 
-		return iterable
+	def __len__(self):
+		return math.ceil(self.get_num_windows() / self.num_replicas)
 
 	def get_num_steps(self):
 		"""
@@ -159,12 +520,14 @@ class WindowBatchSampler(torch.utils.data.Sampler):
 		num_steps = (len(self.data_source) - self.batch_size) / self.batch_step_size
 		num_steps = math.floor(num_steps) if (self.method in ('trunc',)) \
 			else math.ceil(num_steps)
+		if (self.batch_step_size * num_steps >= len(self.data_source)):
+			num_steps -= 1 # last window would start past the end of the data (step > batch size)
 		return num_steps
 
 	"""
-	Get the number of windows (batches) the iterator moves through.
+	Get the number of windows (batches) in an epoch (over all replicas).
 	"""
-	__len__ = get_num_windows = lambda self: self.get_num_steps() + 1
+	get_num_windows = lambda self: self.get_num_steps() + 1
 
 	"""
 	Get the first index of the last batch (ie beginning of the last step)
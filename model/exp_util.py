@@ -77,6 +77,7 @@ def modify_model_params(params_m, sm_name, model_name):
 			params_m['use_lat_path'] = True
 
 def get_model(params_m, params_d, sm_name, model_name, splits, dm):
+	params_m = {**params_m, "masked": dm.is_padded()} # mask the input only if the data has padded days
 	modify_model_params(params_m, sm_name, model_name)
 	if (sm_name in ('stcn', 'StackedTCN', 'GenericModel_StackedTCN')):
 		from model.pl_generic import GenericModel
@@ -223,20 +224,37 @@ def run_exp(study_dir, params_m, params_d, sm_name, model_name, splits, dm, max_
 	trainer = get_trainer(trial_dir, callbacks, params_m['epochs'], max_epochs,
 		model.precision, seed)
 	# logging.debug(f'gpu mem (mb): {torch.cuda.max_memory_allocated()}')
+	dm.set_fields(model.TRAIN_FIELDS)
 	trainer.fit(model, datamodule=dm)
 	if ('test' in splits):
 		trainer.test(model, datamodule=dm, verbose=False)
 	return trial_dir, model, trainer
 
-def dump_exp(trial_dir, params_m, params_d, sm_name, model_name, splits, dm, model, trainer, metrics=["loss", "reg_mse", "reg_mae"]):
-	# Dump prediction plots
-	dfs_pred = {split: model.pred_df(dm.get_dataloader(split), dm.index[split]) for split in splits}
+def dump_pred(trial_dir, sm_name, model_name, splits, dm, model):
+	"""
+	Dump the predictions of each split and their plots, one plot per asset for a pooled multi asset data module.
+	"""
+	dfs_pred = {split: model.pred_df(dm.get_dataloader(split, fields=model.EVAL_FIELDS), dm.index[split]) for split in splits}
 	for split, df_pred in dfs_pred.items():
 		dump_df(df_pred, f"{split}_pred", trial_dir, "csv")
-		dump_plot_pred(df_pred, trial_dir,
-			dm.target_name,
-			f"{dm.asset_name} {sm_name}_{model_name} {split} {dm.target_name}".lower(),
-			f"plot_{split}_pred")
+		if ("asset" in df_pred.columns):
+			# pooled predictions of a multi asset data module, plot each asset
+			for asset, df_asset in df_pred.groupby("asset"):
+				asset_name = dm.asset_names[asset]
+				dump_plot_pred(df_asset, trial_dir,
+					dm.target_name,
+					f"{asset_name} {sm_name}_{model_name} {split} {dm.target_name}".lower(),
+					f"plot_{split}_pred_{asset_name}")
+		else:
+			dump_plot_pred(df_pred, trial_dir,
+				dm.target_name,
+				f"{dm.asset_name} {sm_name}_{model_name} {split} {dm.target_name}".lower(),
+				f"plot_{split}_pred")
+	return dfs_pred
+
+def dump_exp(trial_dir, params_m, params_d, sm_name, model_name, splits, dm, model, trainer, metrics=["loss", "reg_mse", "reg_mae"]):
+	# Dump prediction plots
+	dump_pred(trial_dir, sm_name, model_name, splits, dm, model)
 
 	# Dump params, results, and metrics over train / val
 	df_hist = fix_metrics_csv(trial_dir)
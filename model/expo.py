@@ -19,10 +19,11 @@ def expo(argv):
 	"""
 	Optuna experiment script
 	"""
-	cmd_arg_list = ['dry-run', 'assets=', 'xdata=', 'ydata=', 'smodel=', 'models=', 'param=', 'obj=']
+	cmd_arg_list = ['dry-run', 'assets=', 'xdata=', 'ydata=', 'smodel=', 'models=', 'param=', 'obj=', 'use-shm']
 	cmd_input = get_cmd_args(argv, cmd_arg_list, script_name=basename(__file__),
 		script_pkg=basename(dirname(__file__)))
 	dry_run = cmd_input['dry-run']
+	use_shm = cmd_input['use-shm'] # share the prepared data with concurrent studies
 	logging.info(f'dry-run: {dry_run}')
 	splits = ('train', 'val')
 
@@ -64,30 +65,34 @@ def expo(argv):
 		logging.info(f'{asset_name=}')
 		logging.info('loading data...')
 		dm = XGDataModule(params_d, asset_name=asset_name,
-			feature_name=feature_name, target_name=target_name)
+			feature_name=feature_name, target_name=target_name, shared=bool(use_shm))
 		dm.prepare_data()
 		dm.setup()
 
-		for model_name in model_names:
-			logging.info(f'{model_name=}')
-			study_dir = get_study_dir(param_dir, model_name, dm.name) +obj +sep
-			study_name = get_study_name(study_dir, dir_path=EXP_DIR)
-			study_db = f'sqlite:///{study_dir}{OPTUNA_DBNAME}.db'
-			makedir_if_not_exists(study_dir)
+		try:
+			for model_name in model_names:
+				logging.info(f'{model_name=}')
+				study_dir = get_study_dir(param_dir, model_name, dm.name) +obj +sep
+				study_name = get_study_name(study_dir, dir_path=EXP_DIR)
+				study_db = f'sqlite:///{study_dir}{OPTUNA_DBNAME}.db'
+				makedir_if_not_exists(study_dir)
 
-			sampler = get_sampler(sm_name, model_name, sampler_type)
-			study = optuna.create_study(storage=study_db, load_if_exists=True,
-				sampler=sampler, direction=optmode, study_name=study_name)
-			suggestor_m = get_model_suggestor(sm_name, model_name)
-			objective_fn = get_objective_fn(study_dir, params_m, params_d, sm_name,
-				model_name, splits, dm, obj, suggestor_m)
-			if (dry_run):
-				logging.info('dry-run: skip study optimize')
-			else:
-				study.optimize(objective_fn, n_trials=OPTUNA_N_TRIALS, timeout=OPTUNA_TIMEOUT*60,
-					catch=(), n_jobs=1, gc_after_trial=False, show_progress_bar=False)
-				study_df = study.trials_dataframe().sort_values(by='value', ascending=True)
-				dump_df(study_df.set_index('number'), f'{OPTUNA_DBNAME}.csv', dir_path=study_dir, data_format='csv')
+				sampler = get_sampler(sm_name, model_name, sampler_type)
+				study = optuna.create_study(storage=study_db, load_if_exists=True,
+					sampler=sampler, direction=optmode, study_name=study_name)
+				suggestor_m = get_model_suggestor(sm_name, model_name)
+				objective_fn = get_objective_fn(study_dir, params_m, params_d, sm_name,
+					model_name, splits, dm, obj, suggestor_m)
+				if (dry_run):
+					logging.info('dry-run: skip study optimize')
+				else:
+					study.optimize(objective_fn, n_trials=OPTUNA_N_TRIALS, timeout=OPTUNA_TIMEOUT*60,
+						catch=(), n_jobs=1, gc_after_trial=False, show_progress_bar=False)
+					study_df = study.trials_dataframe().sort_values(by='value', ascending=True)
+					dump_df(study_df.set_index('number'), f'{OPTUNA_DBNAME}.csv', dir_path=study_dir, data_format='csv')
+		finally:
+			# the last study attached to the shared data frees its memory
+			dm.unpublish()
 		torch.cuda.empty_cache()
 
 if __name__ == '__main__':
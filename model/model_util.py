@@ -241,8 +241,12 @@ class MHA(nn.Module):
 		* n: batch
 		* {S, L}: {source, target} set
 		* E[{q, k, v}]: {query, key, value} embedding
+
+	The attention weights are not computed by default, so torch.nn.MultiheadAttention runs its fused
+	scaled dot product attention path. With capture_weights set (for diagnostics) the per head weights
+	of each layer are kept in self.weights after every forward pass, at the cost of the slower path.
 	"""
-	def __init__(self, in_shape, num_heads=1, dropout=0.0, depth=1, kdim=None, vdim=None):
+	def __init__(self, in_shape, num_heads=1, dropout=0.0, depth=1, kdim=None, vdim=None, capture_weights=False):
 		"""
 		Args:
 			in_shape (tuple): (L, E[q])
@@ -251,11 +255,14 @@ class MHA(nn.Module):
 			depth (int>0): network depth
 			kdim: E[k] (if None, assumes E[k]==E[q])
 			vdim: E[v] (if None, assumes E[v]==E[q])
+			capture_weights (bool): keep the attention weights of each layer, shaped (n, heads, L, S)
 		"""
 		super().__init__()
 		self.in_shape, self.out_shape = in_shape, in_shape
 		self.embed_dim = in_shape[-1]
 		self.num_heads = num_heads
+		self.capture_weights = capture_weights
+		self.weights = None
 		self.mhas = nn.ModuleList([nn.MultiheadAttention(
 			self.embed_dim, self.num_heads, dropout=dropout, bias=True, add_bias_kv=False,
 			add_zero_attn=False, kdim=kdim, vdim=vdim, batch_first=True) for _ in range(depth)])
@@ -282,10 +289,15 @@ class MHA(nn.Module):
 		_k = k if (is_valid(k)) else q
 		_v = v if (is_valid(v)) else q
 
+		weights = []
 		for i, mha in enumerate(self.mhas):
-			q, _ = mha(q, _k, _v, key_padding_mask=key_padding_mask,
-				need_weights=True, attn_mask=attn_mask)
+			q, w = mha(q, _k, _v, key_padding_mask=key_padding_mask,
+				need_weights=self.capture_weights, attn_mask=attn_mask, average_attn_weights=False)
+			if (self.capture_weights):
+				weights.append(w.detach())
 
+		if (self.capture_weights):
+			self.weights = weights
 		return q.contiguous()
 
 class LaplaceAttention(nn.Module):
@@ -299,16 +311,22 @@ class LaplaceAttention(nn.Module):
 		* S: sequence
 
 	act(sum_i(-l1(k - q) / scale))
+	The pairwise L1 distances are computed by torch.cdist, so memory is linear in the sequence length
+	(the [n, C, C, S] difference tensor is never materialized).
 	Adapted from: https://github.com/deepmind/neural-processes/blob/master/attentive_neural_process.ipynb
 	"""
-	def __init__(self, in_shape, scale=2, act='smax'):
+	def __init__(self, in_shape, scale=2, act='smax', kdim=None, vdim=None):
 		"""
 		Args:
 			in_shape (tuple): (C, S)
 			scale (float): L1 distance scale
+			kdim: S of the keys, must equal S of the queries (kept for interface parity with MHA)
+			vdim: S of the values (if None, assumes it equals S)
 		"""
 		super().__init__()
-		self.in_shape, self.out_shape = in_shape, in_shape
+		assert isnt(kdim) or kdim == in_shape[-1], "keys must have the sequence size of the queries"
+		self.in_shape = in_shape
+		self.out_shape = (*in_shape[:-1], vdim or in_shape[-1])
 		self.scale = scale
 		self.out_act = (af := PYTORCH_ACT_MAPPING.get(act, None)) and af()
 
@@ -316,12 +334,9 @@ class LaplaceAttention(nn.Module):
 		if (isnt(k)):
 			# self attention -> use reversed sequence queries as keys
 			k = torch.flip(q, (-1, -2))
-		k = k.unsqueeze(1)				# [n, C, S] -> [n, 1, C, S]
 		v = v if (is_valid(v)) else q			# [n, C, S_v]
-		q = q.unsqueeze(2)				# [n, C, S] -> [n, C, 1, S]
 		try:
-			weights = - (torch.abs(k - q)/self.scale)	# - scaled L1 -> [n, C, C, S]
-			weights = weights.sum(dim=-1)			# [n, C, C, S] -> [n, C, C]
+			weights = -torch.cdist(q, k, p=1) / self.scale	# - scaled L1 -> [n, C, C]
 			if (is_valid(self.out_act)):
 				weights = self.out_act(weights)
 		except Exception as err:
@@ -802,82 +817,128 @@ class AE(nn.Module):
 		return self.model(x)
 
 # ********** NORMALIZATION MODULES **********
+def masked_var_mean(x, mask=None, dim=-1):
+	"""
+	Biased variance and mean of x over dim(s) (kept), only counting the positions where mask is set.
+	Masked positions of x must already be zero.
+
+	Returns:
+		(var, mean, count) where count is the number of positions each statistic is over
+	"""
+	if (isnt(mask)):
+		var, mean = torch.var_mean(x, dim=dim, unbiased=False, keepdim=True)
+		return var, mean, int(np.prod([x.shape[d] for d in (dim if (is_type(dim, tuple, list)) else (dim,))]))
+	count = mask.sum(dim=dim, keepdim=True).clamp(min=1)
+	mean = x.sum(dim=dim, keepdim=True) / count
+	var = ((x - mean).masked_fill(~mask, 0.)**2).sum(dim=dim, keepdim=True) / count
+	return var, mean, count
+
 class InstanceNorm15d(nn.Module):
 	"""
 	Run 1D instance norm over W dimension of input shaped (.., C, H, W), where
-		C -> nchan, creates a separate norm module per channel
+		C -> nchan, each channel has its own affine parameters and running statistics
 		H -> nser
 		W -> series dimension to normalize over
 	Valid input shapes:
 		* (n, C, H, W)
 		* (n, e, C, H, W)
+	Every channel and episode is normalized at once over the reshaped input (no per channel modules),
+	the parameters and buffers are registered so the module follows its parent's device.
+	If a mask is passed (the valid positions of padded input, see AttentiveNP), the masked positions
+	are left out of the statistics and are zero in the output, they must already be zero in the input.
+	Without a mask the input is taken as is, so unpadded input costs no masking.
 	"""
-	def __init__(self, num_channels, num_features, eps=1e-05, momentum=0.1, affine=False, track_running_stats=False, to_cuda=True, **params):
+	masked = True # forward takes a mask
+	per_observation = True # the output of an observation only depends on that observation
+
+	def __init__(self, num_channels, num_features, eps=1e-05, momentum=0.1, affine=False, track_running_stats=False, to_cuda=None, **params):
+		"""
+		Args:
+			to_cuda: unused, kept so older params still load (the module follows its parent's device)
+			**params: factory kwargs (device, dtype) of the parameters and buffers
+		"""
 		super().__init__()
 		self.nchan = num_channels
 		self.nser = num_features
-		self.norm1d = [nn.InstanceNorm1d(self.nser, eps=eps, momentum=momentum,
-			affine=affine, track_running_stats=track_running_stats, **params)
-			for i in range(self.nchan)]
-		if (to_cuda):
-			self.norm1d = [s.cuda() for s in self.norm1d]
+		self.eps = eps
+		self.momentum = momentum
+		self.affine = affine
+		self.track_running_stats = track_running_stats
+		shape = (self.nchan, self.nser)
+		if (self.affine):
+			self.weight = nn.Parameter(torch.ones(shape, **params))
+			self.bias = nn.Parameter(torch.zeros(shape, **params))
+		if (self.track_running_stats):
+			self.register_buffer('running_mean', torch.zeros(shape, **params))
+			self.register_buffer('running_var', torch.ones(shape, **params))
+
+	def get_stat_dims(self, x):
+		return (-1,)
+
+	def get_step_dim(self, x):
+		"""
+		Dim of 5D input that took one running statistics update per index, 4D input took a single update.
+		"""
+		return None if (x.ndim == 4) else 0
 
-	def forward(self, x):
-		if (x.ndim == 4):
-			# use dim=0 as batch dimension for InstanceNorm1d operation, [n, H, W]:
-			chan_out = [self.norm1d[c](x[:, c]).unsqueeze(1) for c in range(self.nchan)]
-			out = torch.cat(chan_out, dim=1)
-		elif (x.ndim == 5):
-			batch_out = []
-			for b in range(x.shape[0]):
-				# use dim=1 as batch dimension for InstanceNorm1d operation, [o, H, W]:
-				chan_out = [self.norm1d[c](x[b, :, c]).unsqueeze(1) for c in range(self.nchan)]
-				batch_out.append(torch.cat(chan_out, dim=1).unsqueeze(0))
-			out = torch.cat(batch_out, dim=0)
-		return out
-
-class BatchNorm15d(nn.Module):
+	def forward(self, x, mask=None):
+		if (self.training or not self.track_running_stats):
+			var, mean, count = masked_var_mean(x, mask, dim=self.get_stat_dims(x))
+			if (self.training and self.track_running_stats):
+				self.update_running_stats(var, mean, count, self.get_step_dim(x))
+		else:
+			var, mean = self.running_var.unsqueeze(-1), self.running_mean.unsqueeze(-1)
+
+		out = (x - mean) * torch.rsqrt(var + self.eps)
+		if (self.affine):
+			out = out * self.weight.unsqueeze(-1) + self.bias.unsqueeze(-1)
+		return out if (isnt(mask)) else out.masked_fill(~mask, 0.)
+
+	@torch.no_grad()
+	def update_running_stats(self, var, mean, count, step_dim=None):
+		"""
+		Update the running statistics with the (unbiased) statistics of the batch, like the per slice
+		nn.InstanceNorm1d/nn.BatchNorm1d calls this replaces: one momentum update per index of step_dim
+		(in order) towards the mean of its statistics, or a single update if step_dim is None.
+		The chained updates are applied at once in closed form:
+			running = (1-m)**k * running + sum_j m * (1-m)**(k-1-j) * stats_j
+		"""
+		unbiased = var * count / (count - 1).clamp(min=1) if (torch.is_tensor(count)) else var * count / max(count - 1, 1)
+		for running, stats in ((self.running_mean, mean), (self.running_var, unbiased)):
+			stats = stats.squeeze(-1)
+			if (isnt(step_dim)):
+				stats = stats.reshape(1, -1, self.nchan, self.nser).mean(dim=1)
+			else:
+				stats = stats.movedim(step_dim, 0)
+				stats = stats.reshape(stats.shape[0], -1, self.nchan, self.nser).mean(dim=1)
+			k = stats.shape[0]
+			decay = (1 - self.momentum) ** torch.arange(k - 1, -1, -1, dtype=stats.dtype, device=stats.device)
+			running.mul_((1 - self.momentum) ** k).add_(torch.einsum('k,kch->ch', self.momentum * decay, stats))
+
+class BatchNorm15d(InstanceNorm15d):
 	"""
 	Run 1D batch norm over (bdim, W) dimensions of input shaped (.., C, H, W), where
-		C -> nchan, creates a separate norm module per channel
+		C -> nchan, each channel has its own affine parameters and running statistics
 		H -> nser
 		W -> series dimension to normalize over
 	Valid input shapes:
 		* (n, C, H, W)
 		* (n, e, C, H, W)
-	Setting bdim determines the batch dim for batch norm (only used if ndim > 4).
-	"""
-	def __init__(self, num_channels, num_features, bdim=1, eps=1e-05, momentum=0.1, affine=False, track_running_stats=False, to_cuda=True, **params):
-		super().__init__()
-		self.nchan = num_channels
-		self.nser = num_features
+	Setting bdim determines the batch dim for batch norm (only used if ndim > 4),
+	the statistics are separate along the other leading dim.
+	Normalizes all channels at once and takes a mask like InstanceNorm15d.
+	"""
+	per_observation = False
+	def __init__(self, num_channels, num_features, bdim=1, eps=1e-05, momentum=0.1, affine=False, track_running_stats=False, to_cuda=None, **params):
+		super().__init__(num_channels, num_features, eps=eps, momentum=momentum, affine=affine,
+			track_running_stats=track_running_stats, to_cuda=to_cuda, **params)
 		self.bdim = bdim
-		self.norm1d = [nn.BatchNorm1d(self.nser, eps=eps, momentum=momentum,
-			affine=affine, track_running_stats=track_running_stats, **params)
-			for i in range(self.nchan)]
-		if (to_cuda):
-			self.norm1d = [s.cuda() for s in self.norm1d]
 
-	def forward(self, x):
-		raise NotImplementedError() # Need to test
-		if (x.ndim == 4):
-			# always use bdim=0 as batch dimension for InstanceNorm1d operation, [n, H, W]:
-			chan_out = [self.norm1d[c](x[:, c]).unsqueeze(1) for c in range(self.nchan)]
-			out = torch.cat(chan_out, dim=1)
-		elif (x.ndim == 5):
-			batch_out = []
-			if (self.bdim == 0):
-				for b in range(x.shape[1]):
-					# use bdim=0 as batch dimension for InstanceNorm1d operation, [n, H, W]:
-					chan_out = [self.norm1d[c](x[:, b, c]).unsqueeze(1) for c in range(self.nchan)]
-					batch_out.append(torch.cat(chan_out, dim=1).unsqueeze(self.bdim))
-			elif (self.bdim == 1):
-				for b in range(x.shape[0]):
-					# use bdim=1 as batch dimension for InstanceNorm1d operation, [o, H, W]:
-					chan_out = [self.norm1d[c](x[b, :, c]).unsqueeze(1) for c in range(self.nchan)]
-					batch_out.append(torch.cat(chan_out, dim=1).unsqueeze(self.bdim))
-			out = torch.cat(batch_out, dim=self.bdim)
-		return out
+	def get_stat_dims(self, x):
+		return (0, -1) if (x.ndim == 4) else (self.bdim, -1)
+
+	def get_step_dim(self, x):
+		return None if (x.ndim == 4) else 1 - self.bdim
 
 
 MODEL_MAPPING = {
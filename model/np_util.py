@@ -294,23 +294,96 @@ class Decoder(nn.Module):
 		return out_dist
 
 
+class EmbeddingCache:
+	"""
+	Feature transform embeddings of dataset rows, stored by row index as rows are first embedded,
+	so over a pass of a loader each unique row is embedded once (see AttentiveNP.embed).
+	The row indices must identify the rows of one dataset (like the ic/it fields of a single asset
+	loader, or of a pooled loader, see PooledEpisodeDataset), the checksum of each row's input is
+	stored along with it so a row index reused for another row raises an error (see check_rows).
+	"""
+	def __init__(self):
+		self.emb = None
+		self.have = None
+		self.sums = None
+
+	def lookup(self, idx, embed_fn, sums):
+		"""
+		Embeddings of the unique rows idx, embed_fn(pos) embeds the rows idx[pos] not stored yet.
+		sums holds the input checksum of each row, the rows stored before must match theirs.
+		"""
+		if (isnt(self.emb)):
+			miss = torch.ones_like(idx, dtype=torch.bool)
+		else:
+			self.grow(int(idx.max()) + 1)
+			miss = ~self.have[idx]
+			check_rows(sums[~miss], self.sums[idx[~miss]])
+		if (miss.any()):
+			pos = miss.nonzero().squeeze(1)
+			emb = embed_fn(pos)
+			if (isnt(self.emb)):
+				self.emb = emb.new_empty((int(idx.max()) + 1, *emb.shape[1:]))
+				self.have = torch.zeros(len(self.emb), dtype=torch.bool, device=idx.device)
+				self.sums = sums.new_empty(len(self.emb))
+			self.emb[idx[pos]] = emb
+			self.have[idx[pos]] = True
+			self.sums[idx[pos]] = sums[pos]
+		return self.emb[idx]
+
+	def grow(self, size):
+		"""
+		Grow the store to hold size rows, its capacity is doubled so growing costs O(1) amortized.
+		"""
+		if (size > len(self.emb)):
+			size = max(size, 2*len(self.emb))
+			emb = self.emb.new_empty((size, *self.emb.shape[1:]))
+			emb[:len(self.emb)] = self.emb
+			have = torch.zeros(size, dtype=torch.bool, device=self.have.device)
+			have[:len(self.have)] = self.have
+			sums = self.sums.new_empty(size)
+			sums[:len(self.sums)] = self.sums
+			self.emb, self.have, self.sums = emb, have, sums
+
+def check_rows(sums, expected):
+	"""
+	Raise if observations given the same row index have different inputs (by their checksums),
+	ie if the row indices don't identify the rows of one dataset and embeddings would be mixed up.
+	"""
+	if (not torch.allclose(sums, expected, equal_nan=True)):
+		raise ValueError("observations sharing a row index have different inputs, "
+			"the row indices (ic, it) must be unique over the rows of the dataset")
+
+
 # ********** MODEL MODULES **********
 class AttentiveNP(nn.Module):
 	"""
 	Attentive Neural Process Module
+
+	Given the dataset row index of every observation (context_i, target_i), observations of the same row
+	are embedded once by the feature transform and gathered back into the episodes, which saves most of
+	the transform when episodes overlap (step_size < context_size + target_size).
+	This is done when it can't change the output (see can_dedupe): in eval mode, or in training
+	if the feature transform is frozen (its dropout is then drawn once per row instead of per observation).
+	An EmbeddingCache extends this across the batches of a pass.
+
+	Set masked if the input holds padded days (see XGDataModule.is_padded), the mask of the padding is then
+	built from the valid length of each day in the window of each observation (the lc/lt episode fields),
+	the padding is zeroed once per forward pass and the mask is passed to the masked input norms (see InstanceNorm15d).
+	Unpadded input is used as is, a NaN in the input that isn't padding is never masked.
 	"""
 	def __init__(self, in_shape, context_size, target_size, out_size=1,
 		in_name='in15d', in_params=None, in_split=False,
 		fn_name=None, fn_params=None, fn_split=False,
 		ft_name='stcn', ft_params=None, use_raw=True, use_det_path=True, use_lat_path=True,
 		det_encoder_params=None, lat_encoder_params=None, decoder_params=None,
-		sample_latent_post=True, sample_latent_prior=False):
+		sample_latent_post=True, sample_latent_prior=False, masked=False):
 		"""
 		Args:
 			in_shape (tuple): shape of the network's input feature
 			context_size (int>0): context set size
 			target_size (int>0): target set size
 			out_size (int>0): size of the label vector
+			masked (bool): whether the input holds padding to mask (by the day lengths passed to forward)
 			det_encoder_params (dict): deterministic encoder hyperparameters
 			lat_encoder_params (dict): latent encoder hyperparameters
 			decoder_params (dict): decoder hyperparameters
@@ -318,6 +391,8 @@ class AttentiveNP(nn.Module):
 		super().__init__()
 		self.in_shape = in_shape
 		self.out_size = out_size
+		self.in_split = in_split
+		self.masked = masked
 		self.sample_latent_post = sample_latent_post
 		self.sample_latent_prior = sample_latent_prior
 		ft_params = ft_params or {}
@@ -374,22 +449,99 @@ class AttentiveNP(nn.Module):
 		# print(f'{self.decoder.out_shape=}')
 		self.out_shape = self.decoder.out_shape
 
-	def forward(self, context_x, context_y, target_x, target_y=None):
+	@staticmethod
+	def fill_padding(x, lengths):
+		"""
+		Zero the padding of short days, so padded positions add nothing to the feature transform.
+		The last dimension of x interleaves the days of the window (position w*window_size + k
+		is element w of the k-th day, see WindowedDataset), element w of a day is padding from its length on.
+
+		Args:
+			x (torch.tensor): input shaped (..., C, H, W*window_size)
+			lengths (torch.tensor): valid length of each day in the window of each observation,
+				shaped (..., window_size)
+
+		Returns:
+			zero filled input and the mask of its valid positions
+		"""
+		window_size = lengths.shape[-1]
+		pos = torch.arange(x.shape[-1], device=x.device)
+		mask = (pos // window_size) < lengths[..., pos % window_size]
+		mask = mask[..., None, None, :].expand_as(x)
+		return x.masked_fill(~mask, 0.), mask
+
+	@staticmethod
+	def normalize(norm, x, mask=None):
+		"""
+		Input norm of x, masked norms (see InstanceNorm15d) leave the padding out of their statistics.
+		"""
+		return norm(x, mask) if (getattr(norm, "masked", False)) else norm(x)
+
+	def can_dedupe(self):
+		"""
+		Whether observations of the same row have the same embedding, so they can be embedded once:
+		the input norms are per observation and the feature transform is deterministic (eval mode) or frozen.
+		"""
+		per_observation = isnt(self.input_norm_fn) or all(getattr(norm, "per_observation", False)
+			for norm in (self.context_input_norm, self.target_input_norm))
+		frozen = not any(p.requires_grad for p in self.feat_transform.parameters())
+		return per_observation and (not self.training or frozen)
+
+	def embed(self, context_x, target_x, context_i=None, target_i=None, emb_cache=None):
+		"""
+		Feature transform of the (normalized) context and target observations,
+		both are run through it in one pass (the transform has no batch statistics).
+		If their row indices are given and can_dedupe() holds only the unique rows are embedded,
+		rows stored in emb_cache by earlier batches aren't embedded again.
+		Observations of the same row must have the same input, this is checked (see check_rows).
+
+		Returns:
+			context and target embeddings shaped (n, e, *emb_shape)
+		"""
+		n_context = context_x.shape[0] * context_x.shape[1]
+		x = torch.cat((collapse_lower(context_x), collapse_lower(target_x)))
+		if (isnt(context_i) or isnt(target_i) or not self.can_dedupe()):
+			h = self.feat_transform(x)
+		else:
+			if (self.in_split):
+				# context and target rows are normalized differently, keep them apart
+				i = torch.cat((context_i.flatten()*2, target_i.flatten()*2 + 1))
+			else:
+				i = torch.cat((context_i.flatten(), target_i.flatten()))
+			uniq, inverse = torch.unique(i, return_inverse=True)
+			first = torch.empty_like(uniq).scatter_(0, inverse, torch.arange(len(i), device=i.device))
+			sums = x.flatten(1).sum(dim=1)
+			check_rows(sums, sums[first][inverse])
+			if (is_valid(emb_cache)):
+				h = emb_cache.lookup(uniq, lambda pos: self.feat_transform(x[first[pos]]), sums[first])[inverse]
+			else:
+				h = self.feat_transform(x[first])[inverse]
+		return uncollapse_lower(h[:n_context], context_x.shape[:2]), uncollapse_lower(h[n_context:], target_x.shape[:2])
+
+	def forward(self, context_x, context_y, target_x, target_y=None, context_i=None, target_i=None, emb_cache=None,
+		context_l=None, target_l=None):
 		"""
 		Propagate context and target through neural process network.
 
+		Args:
+			context_i, target_i (torch.tensor): dataset row index of each observation, see embed()
+			emb_cache (EmbeddingCache): embeddings of the rows seen by earlier batches of the pass
+			context_l, target_l (torch.tensor): day lengths of each observation, required if masked (see fill_padding)
+
 		Returns:
 			latent prior, latent posterior, and output distributions
 		"""
+		context_mask = target_mask = None
+		if (self.masked):
+			assert is_valid(context_l) and is_valid(target_l), "a masked model needs the day lengths of its input"
+			context_x, context_mask = self.fill_padding(context_x, context_l)
+			target_x, target_mask = self.fill_padding(target_x, target_l)
 		if (is_valid(self.input_norm_fn)):
-			context_x = self.context_input_norm(context_x)
-			target_x = self.target_input_norm(target_x)
+			context_x = self.normalize(self.context_input_norm, context_x, context_mask)
+			target_x = self.normalize(self.target_input_norm, target_x, target_mask)
 
 		if (is_valid(self.feat_transform_fn)):
-			context_h = self.feat_transform(collapse_lower(context_x))
-			target_h = self.feat_transform(collapse_lower(target_x))
-			context_h = uncollapse_lower(context_h, context_x.shape[:2])
-			target_h = uncollapse_lower(target_h, target_x.shape[:2])
+			context_h, target_h = self.embed(context_x, target_x, context_i, target_i, emb_cache)
 		else:
 			context_h, target_h = context_x, target_x
 
@@ -18,7 +18,13 @@ from model.common import PYTORCH_ACT_MAPPING, PYTORCH_LOSS_MAPPING, PYTORCH_OPT_
 class GenericModel(pl.LightningModule):
 	"""
 	Generic Pytorch Lightning Wrapper.
+
+	TRAIN_FIELDS/EVAL_FIELDS declare the batch fields the fit/eval steps read (see XGDataModule.set_fields),
+	None means all fields are required.
 	"""
+	TRAIN_FIELDS = None
+	EVAL_FIELDS = None
+
 	def __init__(self, pt_model_fn, params_m, params_d, fshape, splits=('train', 'val')):
 		"""
 		Init method
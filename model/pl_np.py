@@ -12,6 +12,7 @@ import pytorch_lightning as pl
 from common_util import is_type, is_valid, get_fn_params
 from model.common import PYTORCH_LOSS_MAPPING
 from model.pl_generic import GenericModel
+from model.np_util import EmbeddingCache
 
 
 class NPModel(GenericModel):
@@ -36,7 +37,16 @@ class NPModel(GenericModel):
 		kelly (bool): whether to use kelly criterion in simulated return
 		num_workers (int>=0): DataLoader option - number cpu workers to attach
 		pin_memory (bool): DataLoader option - whether to pin memory to gpu
+
+	The returns (zc, zt) are never read, the day lengths (lc, lt) are only read by models masking
+	padded input (see AttentiveNP), and the indices (ic, it) are only read when evaluating
+	(forward_eval, pred_df), so they aren't shipped in training batches.
+	When evaluating the indices also let the model embed each row once per pass (see AttentiveNP.embed),
+	add them to TRAIN_FIELDS to dedupe the training batches of a frozen feature transform.
 	"""
+	TRAIN_FIELDS = ("xc", "yc", "lc", "xt", "yt", "lt")
+	EVAL_FIELDS = ("ic", "xc", "yc", "lc", "it", "xt", "yt", "lt")
+
 	def __init__(self, pt_model_fn, params_m, params_d, fshape, splits=('train', 'val')):
 		"""
 		Init method
@@ -66,19 +76,24 @@ class NPModel(GenericModel):
 		)
 		self.precision = 32
 
-	def forward(self, batch):
+	def forward(self, batch, emb_cache=None):
 		"""
 		Run input through model and return output.
 		Use at test time only.
 		"""
-		ic, xc, yc, zc, it, xt, yt, zt = batch
-		prior, post, pred = self.model(xc, yc, xt, target_y=None)
+		ic, xc, yc, zc, lc, it, xt, yt, zt, lt = batch
+		prior, post, pred = self.model(xc, yc, xt, target_y=None,
+			context_i=ic, target_i=it, emb_cache=emb_cache, context_l=lc, target_l=lt)
 		return (ic, yc), (it, yt), (prior, post, pred)
 
 	def forward_eval(self, dl):
+		"""
+		Run the model over a loader, the rows of the loader's dataset are embedded once over the pass.
+		"""
 		self.eval()
+		emb_cache = EmbeddingCache()
 		with torch.no_grad():
-			outs = [self.forward(b) for b in dl]
+			outs = [self.forward(b, emb_cache) for b in dl]
 
 		ic = torch.cat([i[0][0].flatten() for i in outs])
 		yc = torch.cat([i[0][1].flatten() for i in outs])
@@ -90,40 +105,46 @@ class NPModel(GenericModel):
 		return (ic, yc), (it, yt), (prior, post, pred)
 
 	def pred_df(self, dl, index):
+		"""
+		Predictions over a loader indexed by the date they predict for.
+		The row indices of a pooled loader (see PooledEpisodeDataset) are only unique keys over the rows
+		of every asset, they are mapped back to (asset, row) before indexing, and the frame gets
+		an "asset" column (the asset number) with one prediction per asset and date.
+		"""
 		outs = self.forward_eval(dl)
 		ic, yc = outs[0]
 		it, yt = outs[1]
 		prior, post, out = outs[2]
-		# print(f'{it=}')
-		# print(f'{it.sort()[0]=}')
-		# print(f'{it.sort()[1]=}')
-		# print(torch.equal(it, it.sort()[0]))
-		# sys.exit()
 		pred_mean = torch.cat([i.mean for i in out]).flatten()
 		pred_std = torch.cat([i.variance for i in out]).flatten().sqrt()
 		assert all(len(x)==len(ic) for x in (yc, it, yt, pred_mean, pred_std))
-		return pd.DataFrame.from_dict({
-			"it": index[it], "yt": yt, "ic": index[ic], "yc": yc,
-			"pred_mean": pred_mean, "pred_std": pred_std
-		}).drop_duplicates("it").set_index("it").sort_index()
+		pred = {"yt": yt, "yc": yc, "pred_mean": pred_mean, "pred_std": pred_std}
+		keys = ["it"]
+		if (hasattr(dl.dataset, "get_row")):
+			_, ic = dl.dataset.get_row(ic)
+			pred["asset"], it = dl.dataset.get_row(it)
+			keys.insert(0, "asset")
+		assert max(int(ic.max()), int(it.max())) < len(index), "row indices past the end of the index"
+		pred.update({"it": index[it], "ic": index[ic]})
+		return pd.DataFrame.from_dict(pred).drop_duplicates(keys).set_index("it").sort_index()
 
 	def forward_step(self, batch, batch_idx, epoch_type):
 		"""
 		Run forward pass, calculate step loss, and calculate step metrics.
 		"""
 		train_mode = epoch_type == 'train'
-		ic, xc, yc, zc, it, xt, yt, zt = batch
+		ic, xc, yc, zc, lc, it, xt, yt, zt, lt = batch
 		# print(f'{xc.shape=} {xt.shape=}')
 		dist_type = self.params_m['decoder_params']['dist_type']
 
 		try:
 			prior_dist, post_dist, out_dist = self.model(xc, yc, xt, \
-				target_y=yt if (train_mode) else None)
+				target_y=yt if (train_mode) else None, context_i=ic, target_i=it, context_l=lc, target_l=lt)
 		except Exception as err:
 			print("Error! pl_np.py > NPModel > forward_step() > model()\n",
 				sys.exc_info()[0], err)
 			print(f'{train_mode=}')
-			print(f'{xc.shape=},{yc.shape=},{zc.shape=}')
+			print(f'{xc.shape=},{yc.shape=}')
 			raise err
 
 		try: